@@ -0,0 +1,233 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from qualtrics_api.Qv3_store import MISSING, ResponseStore
+
+# Synthetic survey shaped like the ITMRP survey: one single-answer question, one multiple-answer question
+# and a 14-item NARS Likert matrix.  Answers are generated straight into columns so that building the
+# dataset doesn't dominate the timings.
+NARS_COLS = ["Q5.1_{0}".format(i) for i in range(1, 15)]
+MA_CHOICES = 11
+
+def synthetic_survey():
+    questions = {
+        "QID1": {"questionType": {"type": "MC", "selector": "SAVR", "subSelector": None},
+                 "choices": {str(i): {"choiceText": "Age {0}".format(i)} for i in range(1, 7)}},
+        "QID2": {"questionType": {"type": "MC", "selector": "MAVR", "subSelector": None},
+                 "choices": {str(i): {"choiceText": "Game {0}".format(i)} for i in range(1, MA_CHOICES+1)}},
+        "QID3": {"questionType": {"type": "Matrix", "selector": "Likert", "subSelector": "SingleAnswer"},
+                 "choices": {str(i): {"description": str(i)} for i in range(1, 6)},
+                 "subQuestions": {str(i): {"description": "NARS {0}".format(i)} for i in range(1, 15)}},
+    }
+    ecm = {"Q2.1": {"question": "QID1"}}
+    for i in range(1, MA_CHOICES+1):
+        ecm["Q2.5_{0}".format(i)] = {"question": "QID2", "choice": "QID2.choices.{0}".format(i)}
+    for i, col in enumerate(NARS_COLS, 1):
+        ecm[col] = {"question": "QID3", "subQuestion": "QID3.subQuestions.{0}".format(i)}
+    return {"id": "SV_benchmark", "name": "Benchmark", "questions": questions, "exportColumnMap": ecm}
+
+def synthetic_store(n, seed=0, missing=0.05):
+    rng = np.random.default_rng(seed)
+    rids = ["R_{0:010d}".format(i) for i in range(n)]
+    coded = {"Q2.1": rng.integers(1, 7, n, dtype=np.int8)}
+    for col in NARS_COLS:
+        codes = rng.integers(1, 6, n, dtype=np.int8)
+        codes[rng.random(n) < missing] = MISSING
+        coded[col] = codes
+    masks = {"Q2.5": rng.integers(0, 1 << MA_CHOICES, n, dtype=np.uint64)}
+    return ResponseStore.from_columns(synthetic_survey(), rids, coded, masks=masks)
+
+def timeit(fn, repeat):
+    best = float("inf")
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def report_scaling(name, sizes, times):
+    for n, t in zip(sizes, times):
+        sys.stdout.write("{0:>10} {1:>10} responses {2:10.4f} s {3:8.1f} ns/response\n".format(name, n, t, t/n*1e9))
+    if len(sizes) > 1:
+        # slope of log(time) against log(N): 1.0 is linear scaling
+        slope = np.polyfit(np.log(sizes), np.log(times), 1)[0]
+        sys.stdout.write("{0:>10} scaling exponent {1:.2f}\n".format(name, slope))
+
+def synthetic_responses(store, columns):
+    # Response dicts as they come out of the JSON export, restricted to the given coded columns and MA questions
+    data = {"ResponseID": store.rids}
+    for col in columns:
+        if col in store.coded:
+            data[col] = ["" if c == MISSING else str(c) for c in store.codes(col)]
+        else:
+            for j in store.ma_columns(col):
+                data[j] = np.where(store.selected(j), "1", "")
+    keys = list(data)
+    return [dict(zip(keys, row)) for row in zip(*data.values())]
+
+# The joins as they were before the columnar store, kept for comparison.  The original chained assignments
+# (data.loc[rid][j] = ...) write nothing under pandas copy-on-write, so they are made through .at instead
+def legacy_associate_mc(nars, responses, nars_s1, nars_s2, nars_s3, questions):
+    resp = nars_s1.index
+    template = {"nars_s1_mean":nars_s1['mean'], "nars_s1_std":nars_s1['std'], 
+                "nars_s2_mean":nars_s2['mean'], "nars_s2_std":nars_s2['std'], 
+                "nars_s3_mean":nars_s3['mean'], "nars_s3_std":nars_s3['std']}
+    for i in questions:
+        template[i] = pd.Series(dtype=object) # the answers are strings
+    data = pd.DataFrame(template)
+    for i in responses:
+        rid = i['ResponseID']
+        if rid in resp:
+            for j in questions:
+                data.at[rid, j] = i[j]
+    return data
+def legacy_associate_ma(nars, responses, nars_s1, nars_s2, nars_s3, questions):
+    resp = nars_s1.index
+    template = {"nars_s1_mean":nars_s1['mean'], "nars_s1_std":nars_s1['std'], 
+                "nars_s2_mean":nars_s2['mean'], "nars_s2_std":nars_s2['std'], 
+                "nars_s3_mean":nars_s3['mean'], "nars_s3_std":nars_s3['std']}
+    qcols = {}
+    for i in nars.survey['exportColumnMap'].keys():
+        if i.startswith(questions[0]+"_"):
+            if i.endswith("_TEXT"):
+                continue
+            qcols[i] = nars.survey['exportColumnMap'][i]['choice'].split(".")
+    qn = sorted(qcols.keys(), key=lambda k: int(qcols[k][2]))
+    for i in qn:
+        template[i] = pd.Series()
+    data = pd.DataFrame(template)
+    for i in responses:
+        rid = i['ResponseID']
+        if rid in resp:
+            for j in qn:
+                if i[j]:
+                    a = 1
+                else:
+                    a = 0
+                data.at[rid, j] = a
+    return data
+
+def bench_nars(args):
+    import nars as Nars
+    times = []
+    for n in args.sizes:
+        store = synthetic_store(n)
+        nars = Nars.Nars(store.survey, None, store=store)
+        times.append(timeit(lambda: (nars.score(NARS_COLS[:6]), nars.score(NARS_COLS[6:11]), nars.score(NARS_COLS[11:], inverted=True)), args.repeat))
+    report_scaling("nars", args.sizes, times)
+
+def bench_associate(args):
+    import nars as Nars
+    times = {"mc": [], "ma": [], "legacy_mc": [], "legacy_ma": []}
+    legacy_sizes = []
+    for n in args.sizes:
+        store = synthetic_store(n)
+        nars = Nars.Nars(store.survey, None, store=store)
+        s1, s2, s3 = nars.nars(NARS_COLS[:6]), nars.nars(NARS_COLS[6:11]), nars.nars(NARS_COLS[11:], inverted=True)
+        times["mc"].append(timeit(lambda: nars.associate_mc(s1, s2, s3, ["Q2.1"]), args.repeat))
+        times["ma"].append(timeit(lambda: nars.associate_ma(s1, s2, s3, ["Q2.5"]), args.repeat))
+        if n > args.legacy_max:
+            continue
+        legacy_sizes.append(n)
+        responses = synthetic_responses(store, ["Q2.1", "Q2.5"])
+        times["legacy_mc"].append(timeit(lambda: legacy_associate_mc(nars, responses, s1, s2, s3, ["Q2.1"]), 1))
+        times["legacy_ma"].append(timeit(lambda: legacy_associate_ma(nars, responses, s1, s2, s3, ["Q2.5"]), 1))
+    report_scaling("assoc_mc", args.sizes, times["mc"])
+    report_scaling("assoc_ma", args.sizes, times["ma"])
+    if legacy_sizes:
+        report_scaling("legacy_mc", legacy_sizes, times["legacy_mc"])
+        report_scaling("legacy_ma", legacy_sizes, times["legacy_ma"])
+        for i, n in enumerate(legacy_sizes):
+            sys.stdout.write("{0:>10} responses speedup mc {1:.0f}x ma {2:.0f}x\n".format(n,
+                times["legacy_mc"][i] / times["mc"][i], times["legacy_ma"][i] / times["ma"][i]))
+    skipped = [n for n in args.sizes if n > args.legacy_max]
+    if skipped:
+        sys.stdout.write("legacy joins skipped above --legacy-max {0}: {1}\n".format(args.legacy_max, skipped))
+
+def bench_bitset(args):
+    # Multiple-answer kernels on the Q2.5 bitmasks, against counting one bit at a time as bitcounts used to
+    from qualtrics_api import Qv3_stats as QS
+    times = {"bits": [], "bits_loop": [], "cosel": [], "popcount": []}
+    for n in args.sizes:
+        masks = synthetic_store(n).mask("Q2.5")
+        times["bits"].append(timeit(lambda: QS.bit_counts(masks, MA_CHOICES), args.repeat))
+        times["bits_loop"].append(timeit(lambda: [((masks >> np.uint64(b)) & np.uint64(1)).sum() for b in range(MA_CHOICES)], args.repeat))
+        times["cosel"].append(timeit(lambda: QS.coselection(masks, MA_CHOICES), args.repeat))
+        times["popcount"].append(timeit(lambda: QS.popcount(masks), args.repeat))
+    for name, t in times.items():
+        report_scaling(name, args.sizes, t)
+
+def bench_snapshot(args):
+    # Writing a snapshot, opening it memory-mapped, and opening it plus scoring one NARS subscale from it
+    import nars as Nars
+    times = {"snap_save": [], "snap_load": [], "snap_nars": []}
+    for n in args.sizes:
+        store = synthetic_store(n)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "snapshot")
+            times["snap_save"].append(timeit(lambda: store.save(path), 1))
+            times["snap_load"].append(timeit(lambda: ResponseStore.load(path), args.repeat))
+            def first_scores():
+                loaded = ResponseStore.load(path)
+                Nars.Nars(loaded.survey, None, store=loaded).score(NARS_COLS[:6])
+            times["snap_nars"].append(timeit(first_scores, args.repeat))
+    for name, t in times.items():
+        report_scaling(name, args.sizes, t)
+
+ANALYZER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "itmrp-analyzer.py")
+
+def import_times(argv):
+    # Runs a fresh interpreter with -X importtime; returns the cumulative import time (in us) of each top-level
+    # import and the wall time of the whole run
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime"] + argv, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit() and not name.startswith("  "): # nested imports are indented further
+            times[name.strip()] = int(cumulative)
+    return times, wall
+
+def bench_startup(args):
+    # Imports the analyzer needs beyond the bare interpreter, for commands that must not load any data
+    baseline, wall = import_times(["-c", "pass"])
+    ok = True
+    for argv in (["--help"], ["report", "--help"]):
+        runs = [import_times([ANALYZER] + argv) for i in range(args.repeat)]
+        times, wall = min(runs, key=lambda r: sum(v for k, v in r[0].items() if k not in baseline))
+        extra = {k: v for k, v in times.items() if k not in baseline}
+        total = sum(extra.values()) / 1000
+        within = total <= args.budget
+        ok &= within
+        sys.stdout.write("{0:>20} {1:8.1f} ms imports {2:8.1f} ms wall  budget {3} ms: {4}\n".format(" ".join(argv), total,
+            wall * 1000, args.budget, "ok" if within else "OVER"))
+        for name, us in sorted(extra.items(), key=lambda i: -i[1])[:5]:
+            sys.stdout.write("{0:>20} {1:8.1f} ms {2}\n".format("", us / 1000, name))
+    return ok
+
+BENCHMARKS = {"nars": bench_nars, "associate": bench_associate, "bitset": bench_bitset, "snapshot": bench_snapshot, "startup": bench_startup}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run: {0} (default: all)".format(", ".join(sorted(BENCHMARKS))))
+    parser.add_argument("-n", "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="Response counts to benchmark")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Repetitions per size (the best time is reported)")
+    parser.add_argument("--legacy-max", type=int, default=100000, help="Largest response count to run the pre-store implementations on")
+    parser.add_argument("--budget", type=float, default=50, help="Import time budget of the analyzer's startup in ms; exits with 1 when over")
+    args = parser.parse_args()
+    for b in args.benchmarks:
+        if b not in BENCHMARKS:
+            parser.error("unknown benchmark {0}".format(b))
+    failed = [b for b in args.benchmarks or sorted(BENCHMARKS) if BENCHMARKS[b](args) is False]
+    if failed:
+        sys.exit(1)
@@ -1,65 +1,197 @@
 import argparse
 import importlib
-import json
-import matplotlib
-from matplotlib import rcParams as mp_rc
 import sys
 
-import nars as Nars
-import pdplot as p
-import qualtrics_api.Qv3 as Qv3
-import qualtrics_api.Qv3_helpers as QH
-import run_graphs
-import settings
-import util as u
+# matplotlib, pandas, numpy and the modules built on them are imported by imports() on first use, and the survey is
+# only loaded (from the cache or Qualtrics) when its data is first needed, so that --help and sub-commands start fast
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-R", "--results", help="Sets the results file without re-downloading the results from Qualtrics", default=None)
+parser.add_argument("-F", "--refresh", help="Ignore the local cache and download the survey and results from Qualtrics again", action="store_true")
+parser.add_argument("-a", "--all-columns", help="Keep every exported column instead of only the ones used by settings and run_graphs", action="store_true")
+commands = parser.add_subparsers(dest="command", help="Run a command and exit instead of starting an interactive session")
+report_parser = commands.add_parser("report", help="Render graphs and tables to files without IPython or a terminal (e.g. from cron)")
+report_parser.add_argument("-o", "--output", help="Directory to write the graphs and tables to", default="report")
+report_parser.add_argument("-g", "--graphs", help="Graphs and tables to render (default: all)", nargs="+", default=None)
+report_parser.add_argument("-f", "--formats", help="Image formats to write", nargs="+", default=["png"], choices=["png", "svg", "pdf"])
+report_parser.add_argument("-j", "--jobs", help="Number of graphs to render in parallel (default: one per CPU)", type=int, default=None)
 args = parser.parse_args()
 
-try:
-    __IPYTHON__
-    sys.stderr.write("Type '%matplotlib' (without the quotes) to initialize IPython\n")
-except NameError:
-    sys.stderr.write("Warning: This script was designed for IPython.  Running without IPython may yield unexpected results.\n")
+if args.command is None:
+    try:
+        __IPYTHON__
+        sys.stderr.write("Type '%matplotlib' (without the quotes) to initialize IPython\n")
+    except NameError:
+        sys.stderr.write("Warning: This script was designed for IPython.  Running without IPython may yield unexpected results.\n")
+
+# Local modules in the order reload() reloads them: every module after the ones it imports names from, so that
+# `from ... import` picks up the reloaded code; settings first, as the graph registry and helpers read it
+LOCAL_MODULES = ("settings",
+    "qualtrics_api.Qv3_schema", "qualtrics_api.Qv3_stats", "qualtrics_api.Qv3_filter", "qualtrics_api.Qv3_store",
+    "qualtrics_api.Qv3_stream", "qualtrics_api.Qv3_helpers", "nars",
+    "qualtrics_api.Qv3_pool", "qualtrics_api.Qv3_poll", "qualtrics_api.Qv3_download", "qualtrics_api.Qv3_workspace",
+    "qualtrics_api.Qv3", "qualtrics_api.Qv3_async", "qualtrics_api.Qv3_cache",
+    "util", "pdplot", "render", "run_graphs")
+
+def imports():
+    global matplotlib
+    global Nars
+    global p
+    global Qv3
+    global QC
+    global QH
+    global QS
+    global QJ
+    global run_graphs
+    global settings
+    global u
+    import matplotlib.style
+    import nars as Nars
+    import pdplot as p
+    import qualtrics_api.Qv3 as Qv3
+    import qualtrics_api.Qv3_cache as QC
+    import qualtrics_api.Qv3_helpers as QH
+    import qualtrics_api.Qv3_store as QS
+    import qualtrics_api.Qv3_stream as QJ
+    import run_graphs
+    import settings
+    import util as u
+
+class Deferred:
+    # Stands in for a session global until the data is first used, then loads everything with init()
+    def __init__(self, name):
+        self.name = name
+    def resolve(self):
+        init()
+        return globals()[self.name]
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+    def __getitem__(self, key):
+        return self.resolve()[key]
+    def __repr__(self):
+        return "<{0}: not loaded yet>".format(self.name)
+
+def deferred():
+    global q
+    global cache
+    global survey
+    global store
+    global nars
+    global qh
+    q, cache, survey, store, nars, qh = [Deferred(n) for n in ("q", "cache", "survey", "store", "nars", "qh")]
+
+def loaded():
+    return not isinstance(store, Deferred)
 
 
+def survey_ids():
+    # settings.qualtrics_survey is a survey ID, or a list of them to analyze several surveys
+    sids = settings.qualtrics_survey
+    return list(sids) if isinstance(sids, (list, tuple)) else [sids]
+
 def qualtrics_init(reuse=False):
+    # reuse accepts any cached survey definition, even one older than the cache TTL
     global q
-    global args
+    global cache
     global survey
+    global surveys
     global survey_data
+    global store
+    global stores
     global N
-    q = Qv3.Qualtrics_v3(settings.qualtrics_datacenter,settings.qualtrics_api_key)
+    imports()
+    q = Qv3.Qualtrics_v3(settings.qualtrics_datacenter,settings.qualtrics_api_key, workspace_quota=getattr(settings, "workspace_quota", None))
+    cache = QC.ExportCache(getattr(settings, "cache_dir", "~/.cache/itmrp"), ttl=getattr(settings, "cache_ttl", 3600),
+        max_bytes=getattr(settings, "cache_max_bytes", 2*1024*1024*1024))
     sys.stdout.write("Loading survey from Qualtrics...")
-
+    surveys = [cache.survey(q, sid, max_age=None if reuse else -1, refresh=args.refresh) for sid in survey_ids()]
+    survey = surveys[0]
     sys.stdout.write("done!\n")
-    if args.results:
-        reuse = True
-    else:
-        survey_file = q.response_export(settings.qualtrics_survey,"json")
-        sys.stdout.write("Opening {0}\n".format(survey_file))
-    if reuse:
+    columns = None if args.all_columns else analysis_columns()
+    stores = {}
+    if len(surveys) > 1 and not args.results:
+        # Several surveys: exported together, then combined into one dataset or kept apart (switch with use())
+        files = cache.export_many(q, surveys, "json", refresh=args.refresh, concurrency=getattr(settings, "export_concurrency", 4))
+        try:
+            if getattr(settings, "combine_surveys", True):
+                store = QS.ResponseStore.combined(surveys, [QJ.iter_responses(files[s['id']]) for s in surveys], columns=columns)
+            else:
+                for s in surveys:
+                    stores[s['id']] = cache.store(files[s['id']].name, s, columns=columns)
+                store = stores[survey['id']]
+        finally:
+            for f in files.values():
+                f.close()
+    elif args.results:
         survey_file = args.results
         sys.stdout.write("Reusing results from {0}\n".format(survey_file))
-    with open(survey_file) as data_file:    
-        survey_data = json.load(data_file)
+        with open(survey_file) as data_file:
+            store = QS.ResponseStore(survey, QJ.iter_responses(data_file), columns=columns)
+    else:
+        data_file, delta = cache.sync(q, survey, "json", refresh=args.refresh)
+        data_file.close()
+        sys.stdout.write("Opening {0}\n".format(data_file.name))
+        store = cache.store(data_file.name, survey, columns=columns) # memory-mapped snapshot after the first load
+    survey_data = None # responses are parsed incrementally straight into the store
+    N = store.N
+    sys.stdout.write("Imported {0} responses\n".format(N))
 
-    N = len(survey_data['responses'])
+    sys.stdout.write("Survey Name: {0}\n".format(", ".join(s['name'] for s in surveys)))
 
-    survey = q.survey_get(settings.qualtrics_survey)
-    sys.stdout.write("Imported {0} responses\n".format(N))
+def use(sid):
+    # Switches the session to one survey's dataset when several surveys are loaded without combine_surveys
+    global survey
+    global store
+    global N
+    if not loaded():
+        init()
+    if sid not in stores:
+        if len(surveys) > 1 and getattr(settings, "combine_surveys", True):
+            raise RuntimeError("Per-survey selection is unavailable when surveys are combined; set combine_surveys = False in settings")
+        raise RuntimeError("Survey {0} isn't loaded separately (loaded: {1})".format(sid, ", ".join(stores) or "none"))
+    survey = stores[sid].survey
+    store = stores[sid]
+    N = store.N
+    local_init()
 
-    sys.stdout.write("Survey Name: {0}\n".format(survey['name']))
+def sync():
+    # Pulls the responses recorded since the last export into the running session
+    global survey
+    global N
+    if not loaded():
+        init()
+        return
+    latest = cache.survey(q, survey_ids()[0], refresh=True) if len(surveys) == 1 else None
+    if latest is None or args.results or latest.get('lastModifiedDate') != survey.get('lastModifiedDate'):
+        init() # the survey itself changed (or the results came from a file, or there are several surveys), start over
+        return
+    data_file, delta = cache.sync(q, latest, "json")
+    data_file.close()
+    if delta is None:
+        init()
+        return
+    survey = latest
+    store.append(delta)
+    N = store.N
+    sys.stdout.write("Added {0} responses ({1} total)\n".format(len(delta), N))
+
+def analysis_columns():
+    # Columns referenced by the NARS subscales in settings and by run_graphs
+    columns = set(run_graphs.COLUMNS)
+    for k, v in vars(settings).items():
+        if k.startswith("nars_") and isinstance(v, list):
+            columns.update(v)
+    return columns
 
 def local_init():
     global nars
     global qh
+    imports()
     matplotlib.style.use('ggplot')
-    mp_rc.update({'figure.autolayout': True})
+    matplotlib.rcParams.update({'figure.autolayout': True})
     u.reload_window()
-    nars = Nars.Nars(survey, survey_data)
-    qh = QH.QHelpers(q, survey_data)
+    nars = Nars.Nars(survey, survey_data, store=store)
+    qh = QH.QHelpers(q, survey_data, store=store)
 
 def init(reuse=False, noQ=False):
     if not noQ:
@@ -76,17 +208,30 @@ def nars_mrp_calc():
 #TODO: Text analysis (report) Grab text with selectable metadata, filtering null answers
 
 def rg(graph=None, **kwargs):
+    if not loaded():
+        init()
     run_graphs.run_graphs(graph=graph, qh=qh, nars=nars, nars_calc=nars_calc, nars_mrp_calc=nars_mrp_calc, **kwargs)
 
+def report():
+    # Loads the cached (or -R) results, renders the selected graphs and tables to args.output and exits
+    import matplotlib
+    matplotlib.use("Agg") # never start an interactive backend
+    init()
+    paths = run_graphs.run_graphs(graph=args.graphs, qh=qh, nars=nars, nars_calc=nars_calc, nars_mrp_calc=nars_mrp_calc,
+        outdir=args.output, formats=args.formats, workers=args.jobs)
+    sys.stdout.write("Wrote {0} files to {1}\n".format(sum(len(v) for v in paths.values()), args.output))
+
 def reload(noQ=False):
     sys.stdout.write("Reloading local files with importlib...\n")
-    importlib.reload(Nars)
-    importlib.reload(p)
-    importlib.reload(Qv3)
-    importlib.reload(QH)
-    importlib.reload(run_graphs)
-    importlib.reload(settings)
-    importlib.reload(u)
-    init(reuse=True, noQ=noQ)
-
-init()
\ No newline at end of file
+    imports()
+    if loaded():
+        nars.invalidate() # scores memoized with the old code and settings must not survive the reload
+    for name in LOCAL_MODULES:
+        if name in sys.modules: # e.g. Qv3_async only once something has used it
+            importlib.reload(sys.modules[name])
+    if loaded() or not noQ:
+        init(reuse=True, noQ=noQ)
+
+deferred()
+if args.command == "report":
+    report()
\ No newline at end of file
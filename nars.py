@@ -1,98 +1,134 @@
 import numpy as np
 import pandas as pd
 
+from qualtrics_api.Qv3_filter import selection
+from qualtrics_api.Qv3_stats import bit_matrix, grouped_stats
+from qualtrics_api.Qv3_store import MISSING, ResponseStore
+
 class Nars:
-    def __init__(self, survey, survey_data):
+    # Every method takes where= to restrict the analysis to a segment of the respondents (see Qv3_filter); the scores
+    # are still computed and memoized for everyone, and the segment is selected from them
+    def __init__(self, survey, survey_data, store=None):
         if not survey:
             raise RuntimeError("You must specify a survey!")
-        if not survey_data:
+        if not survey_data and store is None:
             raise RuntimeError("You must specify survey data!")
         self.survey = survey
         self.survey_data = survey_data
-        self.N = len(survey_data['responses'])
-    def nars_raw(self, nars_list, inverted=False, inversion_base=5):
-        template = {}
-        for i in nars_list:
-            template[i] = pd.Series([np.NaN]*self.N, dtype=np.float64)
-        rawdata = pd.DataFrame(template)
-        rids = []
-        for respondant,i in zip(self.survey_data['responses'], range(self.N)):
-            for sq in nars_list:
-                ans = respondant[sq]
-                if ans == "":
-                    pass # Throw out questions they didn't answer
-                else:
-                    s = int(ans)
-                    if inverted:
-                        rawdata[sq][i] = self.likert_invert(s, inversion_base)
-                    else:
-                        rawdata[sq][i] = s
-            rids.append(respondant['ResponseID'])
-        if len(nars_list) < 1:
-            rawdata = pd.DataFrame(index=rids)
-        else:
-            rawdata.index = rids
-        return rawdata
-    def nars(self, nars_list, inverted=False, inversion_base=5):
-        rawdata = self.nars_raw(nars_list, inverted=inverted, inversion_base=inversion_base)
-        nars_score = pd.DataFrame({'mean':rawdata.mean(1), 'std':rawdata.std(1)})
-        return nars_score
+        if store is None:
+            store = ResponseStore(survey, survey_data['responses'])
+        self.store = store
+        self.scores = {} # (nars_list, inverted, inversion_base) -> (dataset version, rows scored, mean, std, frame)
+        self.hits = 0
+        self.misses = 0
+    @property
+    def N(self):
+        return self.store.N
+    def nars_matrix(self, nars_list, inverted=False, inversion_base=5, rows=slice(None)):
+        # len(rows) x len(nars_list) float matrix of the subscale answers, NaN where the respondent didn't answer
+        codes = np.empty((len(range(*rows.indices(self.N))), len(nars_list)), dtype=np.int32)
+        for j, sq in enumerate(nars_list):
+            codes[:, j] = self.store.codes(sq)[rows]
+        matrix = codes.astype(np.float64)
+        matrix[codes == MISSING] = np.nan
+        if inverted:
+            matrix = self.likert_invert(matrix, inversion_base)
+        return matrix
+    def nars_raw(self, nars_list, inverted=False, inversion_base=5, where=None):
+        matrix = self.nars_matrix(nars_list, inverted=inverted, inversion_base=inversion_base)
+        rawdata = pd.DataFrame(matrix, index=self.store.index, columns=list(nars_list))
+        return self.restrict(rawdata, where)
+    def score(self, nars_list, inverted=False, inversion_base=5, rows=slice(None)):
+        # Per-respondent subscale mean and std over the given rows
+        matrix = self.nars_matrix(nars_list, inverted=inverted, inversion_base=inversion_base, rows=rows)
+        answered = ~np.isnan(matrix)
+        count = answered.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(answered, matrix, 0.0).sum(axis=1) / count
+            dev = np.where(answered, matrix - mean[:, np.newaxis], 0.0)
+            std = np.sqrt((dev**2).sum(axis=1) / (count - 1))
+        std[count < 2] = np.nan # matches pandas: std of fewer than 2 answers is undefined
+        return mean, std
+    def nars(self, nars_list, inverted=False, inversion_base=5, where=None):
+        # Memoized on (nars_list, inverted, inversion_base) and the store's dataset version (epoch, version).  When
+        # responses were only appended since the last call, just the new rows are scored and added to the cached scores
+        key = (tuple(nars_list), inverted, inversion_base)
+        version = (self.store.epoch, self.store.version)
+        cached = self.scores.get(key)
+        if cached is not None and cached[0] == version:
+            self.hits += 1
+            return self.restrict(cached[4], where)
+        self.misses += 1
+        n, mean, std = 0, np.empty(0), np.empty(0)
+        if cached is not None and cached[0][0] == self.store.epoch: # no answers were replaced in place
+            n, mean, std = cached[1:4]
+        new_mean, new_std = self.score(nars_list, inverted=inverted, inversion_base=inversion_base, rows=slice(n, None))
+        mean = np.concatenate([mean, new_mean])
+        std = np.concatenate([std, new_std])
+        nars_score = pd.DataFrame({'mean':mean, 'std':std}, index=self.store.index)
+        self.scores[key] = (version, self.N, mean, std, nars_score)
+        return self.restrict(nars_score, where)
+    def invalidate(self):
+        # Drops every memoized score and resets the counters
+        self.scores = {}
+        self.hits = 0
+        self.misses = 0
+    def cache_info(self):
+        return {"hits":self.hits, "misses":self.misses, "entries":len(self.scores)}
+
+    def rows(self, index, where):
+        # bool array over index (ResponseIDs) of the rows where selects, or None when it selects everyone
+        selected = selection(self.store, where)
+        if selected is None or index.equals(self.store.index):
+            return selected
+        rows = self.store.index.get_indexer(index)
+        return np.where(rows >= 0, selected[rows], False)
+    def restrict(self, data, where):
+        # The rows of a frame or series indexed by ResponseID that where selects
+        keep = self.rows(data.index, where)
+        return data if keep is None else data[keep]
 
-    def mean(self, nars_s):
-        nmv = nars_s['mean']
+    def mean(self, nars_s, where=None):
+        nmv = self.restrict(nars_s, where)['mean']
         return pd.Series([nmv.mean(), nmv.std()], index=["mean", "std"])
-    def means(self, nars_s1, nars_s2, nars_s3):
-        data = {"NARS S1":self.mean(nars_s1), "NARS S2":self.mean(nars_s2), "NARS S3":self.mean(nars_s3)}
+    def means(self, nars_s1, nars_s2, nars_s3, where=None):
+        data = {"NARS S1":self.mean(nars_s1, where), "NARS S2":self.mean(nars_s2, where), "NARS S3":self.mean(nars_s3, where)}
         return pd.DataFrame(data)
 
-    def associate_mc(self, nars_s1, nars_s2, nars_s3, questions):
-        resp = nars_s1.index
+    def associate(self, nars_s1, nars_s2, nars_s3, columns, where=None):
+        # Joins the NARS scores with answer columns (name -> array in store order) on ResponseID in one step
+        # Respondents missing from the store get NaN answers
         template = {"nars_s1_mean":nars_s1['mean'], "nars_s1_std":nars_s1['std'], 
                     "nars_s2_mean":nars_s2['mean'], "nars_s2_std":nars_s2['std'], 
                     "nars_s3_mean":nars_s3['mean'], "nars_s3_std":nars_s3['std']}
-        for i in questions:
-            template[i] = pd.Series()
         data = pd.DataFrame(template)
-        for i in self.survey_data['responses']:
-            rid = i['ResponseID']
-            if rid in resp:
-                for j in questions:
-                    data.loc[rid][j]  = i[j]
-        return data
+        if data.index.equals(self.store.index):
+            answers = columns
+        else:
+            rows = self.store.index.get_indexer(data.index)
+            unknown = rows < 0
+            answers = {}
+            for name, col in columns.items():
+                col = np.asarray(col, dtype=np.float64)[rows]
+                col[unknown] = np.nan
+                answers[name] = col
+        return self.restrict(pd.concat([data, pd.DataFrame(answers, index=data.index)], axis=1), where)
 
-    def associate_ma(self, nars_s1, nars_s2, nars_s3, questions):
-        resp = nars_s1.index
-        template = {"nars_s1_mean":nars_s1['mean'], "nars_s1_std":nars_s1['std'], 
-                    "nars_s2_mean":nars_s2['mean'], "nars_s2_std":nars_s2['std'], 
-                    "nars_s3_mean":nars_s3['mean'], "nars_s3_std":nars_s3['std']}
-        if len(questions) > 1:
-            raise NotImplementedError("Processing batches of questions is not possible at this time")
-        qcols = {}
-        for i in self.survey['exportColumnMap'].keys():
-            if i.startswith(questions[0]+"_"):
-                if i.endswith("_TEXT"):
-                    continue
-                try:
-                    qcols[i] = self.survey['exportColumnMap'][i]['choice'].split(".")
-                except KeyError:
-                    raise RuntimeError("{0} is not a multiple choice-multiple answer question\n".format(qcol))
-        qn = sorted(qcols.keys(), key=lambda k: int(qcols[k][2]))
-        for i in qn:
-            template[i] = pd.Series()
-        data = pd.DataFrame(template)
-        for i in self.survey_data['responses']:
-            rid = i['ResponseID']
-            if rid in resp:
-                for j in qn:
-                    if i[j]:
-                        a = 1
-                    else:
-                        a = 0
-                    data.loc[rid][j]  = a
-        return data
+    def associate_mc(self, nars_s1, nars_s2, nars_s3, questions, where=None):
+        return self.associate(nars_s1, nars_s2, nars_s3, {j: self.store.values(j) for j in questions}, where=where)
+
+    def associate_ma(self, nars_s1, nars_s2, nars_s3, questions, where=None):
+        # One 0/1 column per choice of every question
+        columns = {}
+        for q in questions:
+            cols = self.store.schema.ma(q).columns
+            bits = bit_matrix(self.store.mask(q), len(cols)).astype(np.int8) # every choice in one pass over the masks
+            for i, j in enumerate(cols):
+                columns[j] = bits[:, i]
+        return self.associate(nars_s1, nars_s2, nars_s3, columns, where=where)
 
-    def dropNaN(self, nars_assoc, ignore=[]):
-        newdata = nars_assoc.copy()
+    def dropNaN(self, nars_assoc, ignore=[], where=None):
+        newdata = self.restrict(nars_assoc, where).copy()
         if 's1' not in ignore:
             newdata = newdata[np.isfinite(newdata['nars_s1_mean'])]
         if 's2' not in ignore:
@@ -101,82 +137,42 @@ class Nars:
             newdata = newdata[np.isfinite(newdata['nars_s3_mean'])]
         return newdata
 
-    def associate_ma_mean(self, nars_assoc, qcol):
-        #nars_assoc = self.dropNaN(nars_assoc)
-        qcols = {}
-        for i in self.survey['exportColumnMap'].keys():
-            if i.startswith(qcol+"_"):
-                if i.endswith("_TEXT"):
-                    continue
-                try:
-                    qcols[i] = self.survey['exportColumnMap'][i]['choice'].split(".")
-                except KeyError:
-                    raise RuntimeError("{0} is not a multiple choice-multiple answer question\n".format(qcol))
-        qn = sorted(qcols.keys(), key=lambda k: int(qcols[k][2]))
-        qid = self.survey['exportColumnMap'][qn[0]]['question']
-        question = self.survey['questions'][qid]
-        if question['questionType']['type'] != "MC" and question['questionType']['selector'] != "MAVR":
-            raise RuntimeError("{0} is not a multiple choice-multiple answer question\n".format(qcol))
-            return None
-        choices = question['choices']
-        base = {}
-        idx = ['nars_s1_mean', 'nars_s1_std', 'nars_s2_mean', 'nars_s2_std', 'nars_s3_mean', 'nars_s3_std']
-        for i in qn:
-            subset = nars_assoc.loc[nars_assoc[i] == 1]
-            ns1m = subset['nars_s1_mean'].mean()
-            ns1s = subset['nars_s1_mean'].std()
-            ns2m = subset['nars_s2_mean'].mean()
-            ns2s = subset['nars_s2_mean'].std()
-            ns3m = subset['nars_s3_mean'].mean()
-            ns3s = subset['nars_s3_mean'].std()
-            pds = pd.Series([ns1m, ns1s, ns2m, ns2s, ns3m, ns3s], dtype=np.float64)
-            base[qcols[i][2]] = pds
-        data = pd.DataFrame(base, columns=sorted(base.keys(), key=int))
-        data.index = idx
-        columns = []
-        #ecols 
-        for i in range(len(data.columns)):
-            columns.append(choices[data.columns[i]]['choiceText'])
-        data.columns = columns
+    def group_means(self, nars_assoc, membership, labels, where=None):
+        # Mean, std, count and standard error of the three subscale means within each group, one column per group
+        # membership is an N x len(labels) bool matrix; a respondent can belong to several groups
+        keep = self.rows(nars_assoc.index, where)
+        if keep is not None:
+            nars_assoc = nars_assoc[keep]
+            membership = np.asarray(membership)[keep]
+        subscales = ['nars_s1', 'nars_s2', 'nars_s3']
+        stats = grouped_stats(nars_assoc[[s + "_mean" for s in subscales]].to_numpy(), membership)
+        idx = []
+        rows = []
+        for j, s in enumerate(subscales):
+            idx += [s + "_mean", s + "_std"]
+            rows += [stats["mean"][:, j], stats["std"][:, j]]
+        for j, s in enumerate(subscales):
+            idx += [s + "_count", s + "_sem"]
+            rows += [stats["count"][:, j], stats["sem"][:, j]]
+        data = pd.DataFrame(np.array(rows, dtype=np.float64).reshape(len(rows), len(labels)), index=idx, columns=labels)
         return data
 
-    def associate_mc_mean(self, nars_assoc, qcol):
+    def associate_ma_mean(self, nars_assoc, qcol, where=None):
         #nars_assoc = self.dropNaN(nars_assoc)
-        try:
-            qid = self.survey['exportColumnMap'][qcol]['question']
-            question = self.survey['questions'][qid]
-        except KeyError:
-            raise RuntimeError("{0} is not a multiple choice, single-answer question\n".format(qcol))
-        if question['questionType']['type'] == "MC" and (question['questionType']['selector'] == "SAVR" or question['questionType']['selector'] == "SAHR"):
-            matrix=False
-        elif question['questionType']['type'] == "Matrix" and question['questionType']['subSelector'] == "SingleAnswer":
-            matrix=True
-        else:
-            raise RuntimeError("{0} is not a multiple choice, single-answer type question\n".format(qcol))
-            return None
-        choices = question['choices']
-        base = {}
-        idx = ['nars_s1_mean', 'nars_s1_std', 'nars_s2_mean', 'nars_s2_std', 'nars_s3_mean', 'nars_s3_std']
-        for i in choices.keys():
-            subset = nars_assoc.loc[nars_assoc[qcol] == int(i)]
-            ns1m = subset['nars_s1_mean'].mean()
-            ns1s = subset['nars_s1_mean'].std()
-            ns2m = subset['nars_s2_mean'].mean()
-            ns2s = subset['nars_s2_mean'].std()
-            ns3m = subset['nars_s3_mean'].mean()
-            ns3s = subset['nars_s3_mean'].std()
-            pds = pd.Series([ns1m, ns1s, ns2m, ns2s, ns3m, ns3s], dtype=np.float64)
-            base[i] = pds
-        data = pd.DataFrame(base)
-        data.index = idx
-        columns = []
-        #ecols 
-        for i in range(len(data.columns)):
-            columns.append(choices[data.columns[i]]['choiceText'])
-        data.columns = columns
-        return data
+        nars_assoc = self.restrict(nars_assoc, where)
+        info = self.store.schema.ma(qcol)
+        membership = nars_assoc[info.columns].to_numpy() == 1
+        return self.group_means(nars_assoc, membership, info.column_labels)
 
-    def associate_byinfo(self, nars_s1, nars_s2, nars_s3, info):
+    def associate_mc_mean(self, nars_assoc, qcol, where=None):
+        #nars_assoc = self.dropNaN(nars_assoc)
+        nars_assoc = self.restrict(nars_assoc, where)
+        info = self.store.schema.mc(qcol)
+        keys = np.array([int(i) for i in info.choice_keys])
+        membership = nars_assoc[qcol].to_numpy()[:, np.newaxis] == keys[np.newaxis, :]
+        return self.group_means(nars_assoc, membership, info.choice_labels)
+
+    def associate_byinfo(self, nars_s1, nars_s2, nars_s3, info, where=None):
         #resp = nars_s1.index
         #print(nars_s1['mean'])
         template = {"nars_s1_mean":nars_s1['mean'], "nars_s1_std":nars_s1['std'], 
@@ -186,34 +182,20 @@ class Nars:
         #print(template)
         #print(data)
         data['info'] = info
-        return data
+        return self.restrict(data, where)
 
-    def associate_byinfo_mean(self, nars_assoc, info_labels):
+    def associate_byinfo_mean(self, nars_assoc, info_labels, where=None):
         #nars_assoc = self.dropNaN(nars_assoc)
-        base = {}
-        idx = ['nars_s1_mean', 'nars_s1_std', 'nars_s2_mean', 'nars_s2_std', 'nars_s3_mean', 'nars_s3_std']
-        for i in info_labels.keys():
-            subset = nars_assoc.loc[nars_assoc['info'] == int(i)]
-            ns1m = subset['nars_s1_mean'].mean()
-            ns1s = subset['nars_s1_mean'].std()
-            ns2m = subset['nars_s2_mean'].mean()
-            ns2s = subset['nars_s2_mean'].std()
-            ns3m = subset['nars_s3_mean'].mean()
-            ns3s = subset['nars_s3_mean'].std()
-            pds = pd.Series([ns1m, ns1s, ns2m, ns2s, ns3m, ns3s], dtype=np.float64)
-            base[i] = pds
-        data = pd.DataFrame(base)
-        data.index = idx
-        columns = []
-        #ecols 
-        for i in range(len(data.columns)):
-            columns.append(info_labels[data.columns[i]])
-        data.columns = columns
-        return data
+        nars_assoc = self.restrict(nars_assoc, where)
+        keys = list(info_labels.keys())
+        info = nars_assoc['info'].to_numpy()
+        membership = np.column_stack([info == int(i) for i in keys]) if keys else np.zeros((len(info), 0), dtype=bool)
+        return self.group_means(nars_assoc, membership, [info_labels[i] for i in keys])
 
-    def likert_invert(self, input_num, scale):
+    def likert_invert(self, input_num, scale): # works on single answers and on NaN-padded arrays alike
         if (scale % 2 == 0):
             raise ValueError("Likert scales must be odd numbers!  You provided a scale of {0}".format(scale))
-        if (input_num < 1 or input_num > scale):
+        answers = np.asarray(input_num, dtype=np.float64)
+        if np.any((answers < 1) | (answers > scale)):
             raise ValueError("Likert scale input must be between 1 and {0} inclusive".format(scale))
         return scale - input_num +1
\ No newline at end of file
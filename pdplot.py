@@ -1,5 +1,3 @@
-import matplotlib
-import matplotlib.pyplot as plt
 import textwrap
 
 import plotting_util as u
@@ -43,29 +41,22 @@ def pdplot(pddata, kind='bar', title=None, xlabel=None, ylabel=None, legend=[],
         ax.legend(legend, loc='best')
     return ax
 
-def nars_graphby_mc(nars, nars_s1, nars_s2, nars_s3, question, **kwargs):
-    na = nars.associate_mc(nars_s1, nars_s2, nars_s3, [question])
-    nam = nars.associate_mc_mean(na, question)
+def means_plot(means, **kwargs):
+    # Plots the output of Nars.means, with the std as error bars
+    return pdplot(means.loc['mean'], **kwargs, yerr=means.loc['std'])
+def nars_plot(nam, **kwargs):
+    # Plots the output of Nars.associate_*_mean: subscale means per group, with the std as error bars
     na_means = nam.loc[['nars_s1_mean','nars_s2_mean','nars_s3_mean']]
     na_err = nam.loc[['nars_s1_std','nars_s2_std','nars_s3_std']]
     na_means.index = ["NARS S1", "NARS S2", "NARS S3"]
     na_err.index = ["NARS S1", "NARS S2", "NARS S3"]
     ax = pdplot(na_means, **kwargs, yerr=na_err)
     return ax
+def nars_graphby_mc(nars, nars_s1, nars_s2, nars_s3, question, **kwargs):
+    na = nars.associate_mc(nars_s1, nars_s2, nars_s3, [question])
+    return nars_plot(nars.associate_mc_mean(na, question), **kwargs)
 def nars_graphby_ma(nars, nars_s1, nars_s2, nars_s3, question, **kwargs):
     na = nars.associate_ma(nars_s1, nars_s2, nars_s3, [question])
-    nam = nars.associate_ma_mean(na, question)
-    na_means = nam.loc[['nars_s1_mean','nars_s2_mean','nars_s3_mean']]
-    na_err = nam.loc[['nars_s1_std','nars_s2_std','nars_s3_std']]
-    na_means.index = ["NARS S1", "NARS S2", "NARS S3"]
-    na_err.index = ["NARS S1", "NARS S2", "NARS S3"]
-    ax = pdplot(na_means, **kwargs, yerr=na_err)
-    return ax
+    return nars_plot(nars.associate_ma_mean(na, question), **kwargs)
 def nars_graphby_info(nars, nars_assoc, info_labels, **kwargs):
-    nam = nars.associate_byinfo_mean(nars_assoc, info_labels)
-    na_means = nam.loc[['nars_s1_mean','nars_s2_mean','nars_s3_mean']]
-    na_err = nam.loc[['nars_s1_std','nars_s2_std','nars_s3_std']]
-    na_means.index = ["NARS S1", "NARS S2", "NARS S3"]
-    na_err.index = ["NARS S1", "NARS S2", "NARS S3"]
-    ax = pdplot(na_means, **kwargs, yerr=na_err)
-    return ax
\ No newline at end of file
+    return nars_plot(nars.associate_byinfo_mean(nars_assoc, info_labels), **kwargs)
@@ -1,5 +1,3 @@
-import matplotlib.colors as mpl_colors
-import matplotlib.cm as mpl_cm
 import sys
 import textwrap
 
@@ -23,6 +21,8 @@ def mp_autolabel(rects, ax):
 def mp_get_cmap(N, cmap='hsv'): # from http://stackoverflow.com/a/25628397/1778122
     '''Returns a function that maps each index in 0, 1, ... N-1 to a distinct 
     RGB color.'''
+    import matplotlib.colors as mpl_colors
+    import matplotlib.cm as mpl_cm
     color_norm  = mpl_colors.Normalize(vmin=0, vmax=N-1)
     scalar_map = mpl_cm.ScalarMappable(norm=color_norm, cmap=cmap) 
     def map_index_to_rgb_color(index):
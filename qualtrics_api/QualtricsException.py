@@ -1,3 +1,4 @@
-class QualtricsException():
+class QualtricsException(Exception):
     def __init__(self,message):
-        self.message = message
\ No newline at end of file
+        super().__init__(message)
+        self.message = message
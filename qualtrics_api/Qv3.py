@@ -1,128 +1,331 @@
+import concurrent.futures
+import functools
 import http.client as HTC
+import io
 import json
 import os
-import shutil
 import sys
-import tempfile
 import threading
 import time
-import traceback
 from urllib.parse import urlparse
 import zipfile
 
 from qualtrics_api.QualtricsException import QualtricsException
+from qualtrics_api.Qv3_download import Downloader
+from qualtrics_api.Qv3_poll import ExportPoller
+from qualtrics_api.Qv3_pool import ConnectionPool
+from qualtrics_api.Qv3_workspace import Workspace
+
+def progress_message(stage, done, total):
+    if stage == "export":
+        return "Download is {0}% processed".format(done)
+    elif stage == "download":
+        if total > -1:
+            return "Downloading {0}/{1} MB ({2:.2f})".format(done/1000, total/1000, (done/total*100))
+        else:
+            return "Downloading {0} MB".format(done/1000)
+    elif stage == "downloaded":
+        return "Download finished ({0} MB)".format(done/1000)
+    return None
+
+def print_progress(stage, done, total):
+    # Default progress callback for long-running operations
+    msg = progress_message(stage, done, total)
+    if msg is not None:
+        print(msg)
+
+def print_survey_progress(sid, stage, done, total):
+    # Default progress callback when several surveys are exported at once; one write per line so that the
+    # download threads don't interleave
+    msg = progress_message(stage, done, total)
+    if msg is not None:
+        sys.stdout.write("{0}: {1}\n".format(sid, msg))
+
+def qualtrics_error(raw):
+    return QualtricsException("Qualtrics error {0} ({1})".format(raw["data"]["meta"]["error"]["errorMessage"], raw["data"]["meta"]["error"]["errorCode"]))
+
+def export_request(sid, etype, last_response_id=None, start_date=None, end_date=None):
+    # Body of the POST that starts an export job
+    post = {"surveyId": sid, "format": etype}
+    if last_response_id is not None:
+        post["lastResponseId"] = last_response_id
+    if start_date is not None:
+        post["startDate"] = start_date
+    if end_date is not None:
+        post["endDate"] = end_date
+    return json.dumps(post)
+
+class ExportReader(io.RawIOBase):
+    # Read-only binary stream over the first member of a downloaded export zip; nothing is extracted to disk
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.zip = zipfile.ZipFile(fileobj)
+        self.name = self.zip.namelist()[0]
+        self.member = self.zip.open(self.name)
+        self.download = None # DownloadStats of the download, when it came from one
+    def readable(self):
+        return True
+    def readinto(self, b):
+        return self.member.readinto(b)
+    def read(self, size=-1):
+        return self.member.read(size)
+    def close(self):
+        if not self.closed:
+            self.member.close()
+            self.zip.close()
+            self.fileobj.close()
+        super().close()
+
+class ExportFetch:
+    # The local side of fetching a finished export, shared by Qualtrics_v3 and AsyncQualtrics_v3
+    # Holds a reference to the workspace while the zip is downloaded into `file` (a spool for stream=True, otherwise
+    # its own directory in the workspace, so exports fetched at the same time never collide); result() then builds
+    # what response_export returns and discard() removes whatever a failed download left behind
+    def __init__(self, ws, etype, stream=False, spool_size=64*1024*1024, mmap=False):
+        self.ws = ws
+        self.stream = stream
+        self.mmap = mmap
+        self.stats = None # DownloadStats, set by the caller once the download is done
+        self.file = self.unzip_path = self.zip_path = None
+        ws.acquire()
+        try:
+            if stream:
+                self.file = ws.spool(spool_size)
+            else:
+                self.unzip_path = ws.mkdtemp(prefix="export_{0}_".format(etype))
+                self.zip_path = self.unzip_path + ".zip"
+                self.file = ws.open(self.zip_path)
+        except BaseException:
+            self.discard()
+            ws.release()
+            raise
+    def result(self):
+        # Blocks while the zip is extracted
+        if self.stream:
+            self.file.seek(0)
+            reader = ExportReader(self.file)
+            reader.download = self.stats
+            return reader
+        self.file.close()
+        rdoc_path = self.ws.extract(self.zip_path, self.unzip_path)
+        self.ws.remove(self.zip_path)
+        if self.mmap:
+            return self.ws.map(rdoc_path)
+        return rdoc_path
+    def discard(self):
+        # e.g. over quota: don't leave the partial export behind
+        if self.file is not None:
+            self.file.close()
+        if self.unzip_path is not None and os.path.exists(self.unzip_path):
+            self.ws.remove(self.unzip_path)
+        if self.zip_path is not None and os.path.exists(self.zip_path):
+            self.ws.remove(self.zip_path)
+    def release(self):
+        self.ws.release()
 
 class Qualtrics_v3():
-    def __init__(self, base_uri, api_token):
+    def __init__(self, base_uri, api_token, pool_size=4, timeout=None, scheme="https", workspace_quota=None):
+        # scheme="http" is only meant for talking to a local stand-in server
         self.version = (3)
         self.base_uri = base_uri
+        self.scheme = scheme
         self.token = api_token
         self.api_url = '/API/v3/'
         self.headers = {'X-API-TOKEN': api_token}
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pools = {}
+        self.pools_lock = threading.Lock()
+        self.workspace_quota = workspace_quota # bytes of downloaded and extracted exports allowed, None for no limit
+        self._workspace = None
+    def pool(self, host, scheme="https"):
+        # One keep-alive connection pool per host, created on first use
+        with self.pools_lock:
+            if (scheme, host) not in self.pools:
+                connection_class = HTC.HTTPConnection if scheme == "http" else HTC.HTTPSConnection
+                self.pools[(scheme, host)] = ConnectionPool(host, size=self.pool_size, timeout=self.timeout, connection_class=connection_class)
+            return self.pools[(scheme, host)]
+    def close(self):
+        with self.pools_lock:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools = {}
     def request(self, method, command, data=None, headers={}): 
-        # Primary interface to HTTP client.  Thread safe; initiates one HTTPS connection per operation
+        # Primary interface to HTTP client.  Thread safe; reuses pooled keep-alive HTTPS connections
         # Returns parsed JSON from Qualtrics
         # Does not raise an exception upon HTTP errors; the calling function is responsible for catching errors
-        url_req = "https://{0}/{1}".format(self.base_uri, self.api_url + command)
+        url_req = "{0}://{1}/{2}".format(self.scheme, self.base_uri, self.api_url + command)
         return self.request_url(method, url_req, data=data, headers=headers)
     def request_url(self, method, url, data=None, headers={}, raw=False):
         url_parsed = urlparse(url)
-        if url_parsed.scheme.lower() != "https":
+        if url_parsed.scheme.lower() != "https" and url_parsed.scheme.lower() != self.scheme:
             sys.stdout.write("WARNING: url scheme is not HTTPS!\n")
         if url_parsed.netloc == "":
             sys.stdout.write("WARNING: could not detect network location!\n")  
-        htc = HTC.HTTPSConnection(self.base_uri)
         send_headers = self.headers.copy()
         send_headers.update(headers)
-        htc.request(method, url, body=data, headers=send_headers)
-        resp = htc.getresponse()
+        resp = self.pool(url_parsed.netloc or self.base_uri, url_parsed.scheme.lower()).request(method, url, body=data, headers=send_headers)
         if raw:
-            return resp
-        rt = resp.read().decode('UTF-8')
+            return resp # the connection is returned to the pool once the caller has read the whole body
+        with resp:
+            rt = resp.read().decode('UTF-8')
         data = json.loads(rt)
         return {"stat_code":resp.status, "status_msg":resp.reason, "data":data}
     # surveys!
     def survey_list(self):
-        raw = self.request("GET", "surveys")
-        if raw["stat_code"] != 200:
-            raise QualtricsException("Qualtrics error {0} ({1})".format(raw["data"]["meta"]["error"]["errorMessage"], raw["data"]["meta"]["error"]["errorCode"]))
-        else:
-            data = raw["data"]["result"]["elements"]
-            meta = raw["data"]["meta"]
-            nextpage = raw["data"]["result"]["nextPage"]
-            while(nextpage is not None):
-                npr = self.request_url("GET", nextpage)
-                npd = npr["data"]["result"]["elements"]
-                nextpage = npr["data"]["result"]["nextPage"]
-                data += npd
-            return data
+        return list(self.survey_iter())
+    def survey_iter(self, prefetch=True):
+        # Generator over all surveys of the account, one page of results at a time
+        # With prefetch the request for the next page is already running while the caller works on the current one
+        def page(url):
+            raw = self.request_url("GET", url)
+            if raw["stat_code"] != 200:
+                raise qualtrics_error(raw)
+            return raw["data"]["result"]
+        url = "{0}://{1}/{2}".format(self.scheme, self.base_uri, self.api_url + "surveys")
+        if not prefetch:
+            while url is not None:
+                result = page(url)
+                url = result["nextPage"]
+                yield from result["elements"]
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as fetcher:
+            upcoming = fetcher.submit(page, url)
+            try:
+                while upcoming is not None:
+                    result = upcoming.result()
+                    upcoming = fetcher.submit(page, result["nextPage"]) if result["nextPage"] is not None else None
+                    yield from result["elements"]
+            finally:
+                if upcoming is not None and not upcoming.cancel():
+                    try:
+                        upcoming.result() # let the request finish so its connection goes back to the pool
+                    except Exception:
+                        pass
     def survey_get(self, sid):
         raw = self.request("GET", "surveys/{0}".format(sid))
         if raw["stat_code"] != 200:
-            raise QualtricsException("Qualtrics error {0} ({1})".format(raw["data"]["meta"]["error"]["errorMessage"], raw["data"]["meta"]["error"]["errorCode"]))
+            raise qualtrics_error(raw)
         else:
             data = raw["data"]["result"]
             meta = raw["data"]["meta"]
             return data
 
     # response exports!
-    def response_export(self, sid, etype):
-        start_time = time.time()
+    def export_start(self, sid, etype, last_response_id=None, start_date=None, end_date=None):
+        # Starts an export job on Qualtrics and returns its ID
         headers = {"Content-Type":"application/json"}
-        post = {"surveyId": sid, "format": etype}
-        rdoc_raw = self.request("POST", "responseexports", data=json.dumps(post), headers=headers)
+        data = export_request(sid, etype, last_response_id=last_response_id, start_date=start_date, end_date=end_date)
+        rdoc_raw = self.request("POST", "responseexports", data=data, headers=headers)
         if rdoc_raw["stat_code"] != 200:
-            raise QualtricsException("Qualtrics error {0} ({1})".format(raw["data"]["meta"]["error"]["errorMessage"], raw["data"]["meta"]["error"]["errorCode"]))
-        rdoc_id = rdoc_raw['data']['result']['id']
-        rc_progress = 0
-        rc_command = "responseexports/" + rdoc_id
-        while rc_progress < 100:
-            rc_raw = self.request("GET", rc_command)
-            rc_progress = rc_raw['data']['result']['percentComplete']
-            print("Download is {0}% processed".format(rc_progress))
+            raise qualtrics_error(rdoc_raw)
+        return rdoc_raw['data']['result']['id']
+    def export_check(self, eid):
+        # Progress of an export job: the result with percentComplete and, once complete, the file URL
+        rc_raw = self.request("GET", "responseexports/" + eid)
+        if rc_raw["stat_code"] != 200:
+            raise qualtrics_error(rc_raw)
+        return rc_raw['data']['result']
+    def export_fetch(self, url, etype, callback=print_progress, stream=False, spool_size=64*1024*1024, mmap=False):
+        # Downloads a finished export; see response_export for what is returned
+        fetch = ExportFetch(self.workspace, etype, stream=stream, spool_size=spool_size, mmap=mmap)
+        try:
+            fetch.stats = self.response_download(url, fetch.file, callback=callback)
+            return fetch.result()
+        except BaseException:
+            fetch.discard()
+            raise
+        finally:
+            fetch.release()
+    def response_export(self, sid, etype, poller=None, callback=print_progress, stream=False, spool_size=64*1024*1024,
+            mmap=False, last_response_id=None, start_date=None, end_date=None):
+        # poller schedules the progress checks (see ExportPoller); callback(stage, done, total) reports progress
+        # By default the export is extracted to this session's workspace and the path of the extracted file is returned;
+        # with mmap=True a seekable read-only memory map of it is returned instead, which keeps the workspace (and the
+        # file) alive until it is closed.  With stream=True the zip is downloaded into a spooled buffer (in memory up
+        # to spool_size bytes) and an ExportReader on the exported file is returned instead
+        # Either way the download counts against workspace_quota until the file is removed or the reader closed
+        # last_response_id, start_date and end_date restrict the export to newer responses for incremental syncs
+        if poller is None:
+            poller = ExportPoller()
+        rdoc_id = self.export_start(sid, etype, last_response_id=last_response_id, start_date=start_date, end_date=end_date)
+        poller.start()
+        while True:
+            result = self.export_check(rdoc_id)
+            rc_progress = result['percentComplete']
+            callback("export", rc_progress, 100)
+            if rc_progress >= 100:
+                break
+            poller.wait(rc_progress)
         # download and unzip the file
-        rdoc_url = rc_raw['data']['result']['file']
-        rdoc_req = self.request_url("GET", rdoc_url, raw=True)
-        rdoc_zip_name = "qualtrics_{0}_{1}".format(int(start_time), etype)
-        rdoc_zip_path = tempfile.gettempdir()+"/"+rdoc_zip_name+".zip"
+        return self.export_fetch(result['file'], etype, callback=callback, stream=stream, spool_size=spool_size, mmap=mmap)
+    def response_export_many(self, sids, etype, concurrency=4, poller=ExportPoller, callback=print_survey_progress, stream=False,
+            spool_size=64*1024*1024, mmap=False, **filters):
+        # Exports several surveys at once and returns {sid: path or ExportReader} like response_export
+        # At most `concurrency` surveys are being exported or downloaded at any time.  The running export jobs are
+        # polled together from this thread, each on its own schedule from poller() (an ExportPoller factory), and
+        # finished exports are downloaded in parallel on a thread pool.  callback(sid, stage, done, total) reports progress
+        pending = list(sids)
+        pending.reverse()
+        exporting = {} # sid -> [export ID, poller, progress, time of the next check]
+        downloads = {} # future -> sid
+        results = {}
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
         try:
-            rdoc_size = int(rdoc_req.info().getheader('Content-Length').strip())
-        except AttributeError:
-            rdoc_size = -1
-        rdoc_progress_bytes = 0
-        with open(rdoc_zip_path, "wb") as f: #http://stackoverflow.com/a/27971337/1778122
-            while True:
-                buf = rdoc_req.read(8192)
-                if not buf:
-                    break
-                rdoc_progress_bytes += len(buf)
-                f.write(buf)
-                if rdoc_size > -1:
-                    print("Downloading {0}/{1} MB ({2:.2f})".format(rdoc_progress_bytes/1000, rdoc_size/1000, (rdoc_progress_bytes/rdoc_size*100)))
-                else:
-                    print("Downloading {0} MB".format(rdoc_progress_bytes/1000))
-        print("Download finished to {0}".format(rdoc_zip_path))
-        rdoc_unzip_path = tempfile.gettempdir()+"/"+rdoc_zip_name
-        zipfile.ZipFile(rdoc_zip_path).extractall(rdoc_unzip_path)
-        rdoc_path = rdoc_unzip_path + "/" + os.listdir(rdoc_unzip_path)[0]
-        return rdoc_path
+            while pending or exporting or downloads:
+                while pending and len(exporting) + len(downloads) < concurrency:
+                    sid = pending.pop()
+                    p = poller()
+                    exporting[sid] = [self.export_start(sid, etype, **filters), p, 0, p.clock()]
+                    p.start()
+                for sid, job in list(exporting.items()):
+                    eid, p, progress, due = job
+                    if p.clock() < due:
+                        continue
+                    result = self.export_check(eid)
+                    job[2] = result['percentComplete']
+                    callback(sid, "export", job[2], 100)
+                    if job[2] >= 100:
+                        del exporting[sid]
+                        per_survey = functools.partial(callback, sid)
+                        downloads[pool.submit(self.export_fetch, result['file'], etype, per_survey, stream, spool_size, mmap)] = sid
+                    else:
+                        job[3] = p.clock() + p.next_interval(job[2])
+                timeout = min([max(due - p.clock(), 0) for eid, p, progress, due in exporting.values()], default=None)
+                if downloads:
+                    done, running = concurrent.futures.wait(downloads, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for f in done:
+                        results[downloads.pop(f)] = f.result()
+                elif timeout:
+                    time.sleep(timeout)
+        except BaseException:
+            pool.shutdown(cancel_futures=True)
+            if stream or mmap: # don't leak the open downloads that did finish
+                for f, sid in downloads.items():
+                    if not f.cancelled() and f.exception() is None:
+                        results[sid] = f.result()
+                for reader in results.values():
+                    reader.close()
+            raise
+        pool.shutdown()
+        return {sid: results[sid] for sid in sids}
+    def response_download(self, url, f, callback=print_progress, downloader=None):
+        # Copies a finished export from url into the seekable, readable binary file object f and returns its
+        # DownloadStats; dropped connections are resumed and the zip is checked (see Downloader)
+        if downloader is None:
+            downloader = Downloader(self)
+        return downloader.download(url, f, callback)
 
-    # TODO: cleans up ALL Qualtrics temporary files, not just ones from this session!
+    @property
+    def workspace(self):
+        # This session's temporary directory (see Workspace), created on first use
+        with self.pools_lock:
+            if self._workspace is None or self._workspace.closing:
+                self._workspace = Workspace(quota=self.workspace_quota)
+            return self._workspace
     def response_clean(self):
-        tmp = tempfile.gettempdir()
-        cldir = os.listdir(tmp)
-        dm = []
-        for i in cldir:
-            if i.startswith("qualtrics_"):
-                dm += [i]
-        for i in dm:
-            try:
-                fn = tmp+"/"+i
-                if os.path.isfile(fn):
-                    os.remove(fn)
-                elif os.path.isdir(fn):
-                    shutil.rmtree(fn)
-                else:
-                    sys.stderr.write("ERROR: {0} is not a file or directory\n".format(fn))
-            except PermissionError:
-                traceback.print_exc(file=sys.stderr)
+        # Removes this session's exports; files still open (mmap=True, stream=True) are removed once closed
+        with self.pools_lock:
+            ws, self._workspace = self._workspace, None
+        if ws is not None:
+            ws.close()
@@ -0,0 +1,358 @@
+import asyncio
+import http.client as HTC
+import io
+import json
+import ssl
+import sys
+from urllib.parse import urlparse
+
+from qualtrics_api.Qv3 import ExportFetch, export_request, print_progress, print_survey_progress, qualtrics_error
+from qualtrics_api.Qv3_download import Downloader, Transfer
+from qualtrics_api.Qv3_poll import ExportPoller
+from qualtrics_api.Qv3_pool import IDEMPOTENT
+from qualtrics_api.Qv3_workspace import Workspace
+
+# asyncio counterpart of Qv3: the same calls as coroutines on a small HTTP/1.1 client built on asyncio streams, so
+# pagination, export polling and downloads of many surveys can share one event loop without a thread per request
+
+class AsyncResponse:
+    # Status, headers and body of one HTTP response; the connection goes back to its pool once the body has been read
+    def __init__(self, pool, conn, status, reason, headers, method):
+        self.pool = pool
+        self.conn = conn
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.will_close = headers.get("Connection", "").lower() == "close"
+        self.chunked = headers.get("Transfer-Encoding", "").lower() == "chunked"
+        length = headers.get("Content-Length")
+        self.remaining = int(length) if length is not None and not self.chunked else None # None: chunked or until EOF
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            self.remaining = 0
+            self.chunked = False
+        if self.remaining is None and not self.chunked:
+            self.will_close = True
+        self.chunk_left = 0
+        self.done = False
+        if self.remaining == 0:
+            self.finish()
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+    async def read(self, size=-1):
+        # Up to size bytes of the body (everything that is left for size < 0); b"" at the end
+        if self.done:
+            return b""
+        reader = self.conn[0]
+        if size < 0:
+            parts = []
+            while True:
+                buf = await self.read(1024*1024)
+                if not buf:
+                    return b"".join(parts)
+                parts.append(buf)
+        if self.chunked:
+            if self.chunk_left == 0:
+                line = await reader.readline()
+                if not line:
+                    raise HTC.IncompleteRead(b"")
+                self.chunk_left = int(line.split(b";", 1)[0].strip(), 16)
+                if self.chunk_left == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""): # trailers
+                        pass
+                    self.finish()
+                    return b""
+            buf = await reader.read(min(size, self.chunk_left))
+            if not buf:
+                raise HTC.IncompleteRead(b"")
+            self.chunk_left -= len(buf)
+            if self.chunk_left == 0:
+                await reader.readexactly(2)
+            return buf
+        if self.remaining is None:
+            buf = await reader.read(size)
+            if not buf:
+                self.finish()
+            return buf
+        buf = await reader.read(min(size, self.remaining))
+        if not buf:
+            raise HTC.IncompleteRead(b"", self.remaining)
+        self.remaining -= len(buf)
+        if self.remaining == 0:
+            self.finish()
+        return buf
+    def finish(self):
+        self.done = True
+        self.close()
+    def close(self):
+        if self.conn is None:
+            return
+        # Only a fully-read response leaves the connection in a usable state
+        self.pool.release(self.conn, reuse=self.done and not self.will_close)
+        self.conn = None
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, *exc):
+        self.close()
+
+class AsyncConnectionPool:
+    # Keep-alive connections to a single host for one event loop, at most `size` in use at once
+    def __init__(self, host, size=4, timeout=None, scheme="https"):
+        self.host = host
+        self.timeout = timeout
+        self.scheme = scheme
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+    async def connect(self):
+        host, sep, port = self.host.rpartition(":")
+        if not sep or not port.isdigit():
+            host, port = self.host, None
+        if self.scheme == "https":
+            return await asyncio.wait_for(asyncio.open_connection(host, int(port or 443), ssl=ssl.create_default_context()), self.timeout)
+        return await asyncio.wait_for(asyncio.open_connection(host, int(port or 80)), self.timeout)
+    def release(self, conn, reuse=True):
+        if reuse:
+            self.idle.append(conn)
+        else:
+            conn[1].close()
+        self.slots.release()
+    async def read_head(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise HTC.RemoteDisconnected("Remote end closed connection without response")
+        lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return status_line, b"".join(lines) + b"\r\n"
+            lines.append(line)
+    async def request(self, method, url, body=None, headers={}):
+        url_parsed = urlparse(url)
+        path = url_parsed.path or "/"
+        if url_parsed.query:
+            path += "?" + url_parsed.query
+        if isinstance(body, str):
+            body = body.encode("UTF-8")
+        lines = ["{0} {1} HTTP/1.1".format(method, path), "Host: {0}".format(self.host), "Accept-Encoding: identity"]
+        lines += ["{0}: {1}".format(k, v) for k, v in headers.items()]
+        if body is not None or method in ("POST", "PUT"):
+            lines.append("Content-Length: {0}".format(len(body or b"")))
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+        while True:
+            await self.slots.acquire()
+            reused = bool(self.idle)
+            try:
+                conn = self.idle.pop() if reused else await self.connect()
+            except BaseException:
+                self.slots.release()
+                raise
+            if reused and conn[0].at_eof(): # the server already closed this idle connection
+                self.release(conn, reuse=False)
+                continue
+            sent = False
+            try:
+                conn[1].write(head + (body or b""))
+                await conn[1].drain()
+                sent = True
+                status_line, raw_headers = await asyncio.wait_for(self.read_head(conn[0]), self.timeout)
+            except (HTC.RemoteDisconnected, ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                self.release(conn, reuse=False)
+                if reused and (not sent or method in IDEMPOTENT):
+                    continue # dropped keep-alive connection; retry unless a POST may have reached the server (see ConnectionPool)
+                raise
+            except BaseException:
+                self.release(conn, reuse=False)
+                raise
+            version, status, reason = (status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+            message = HTC.parse_headers(io.BytesIO(raw_headers))
+            return AsyncResponse(self, conn, int(status), reason, message, method)
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+class AsyncDownloader(Downloader):
+    # Downloader for AsyncQualtrics_v3: the same resumes, chunk sizes and checks (see Transfer) with coroutines
+    errors = Downloader.errors + (asyncio.IncompleteReadError,)
+    def __init__(self, q, sleep=asyncio.sleep, **kwargs):
+        super().__init__(q, sleep=sleep, **kwargs)
+    async def open(self, url, offset):
+        return self.opened(await self.q.request_url("GET", url, headers=self.range(offset), raw=True), offset)
+    async def download(self, url, f, callback):
+        t = Transfer(self, f, callback)
+        while True:
+            try:
+                resp, start, size = await self.open(url, t.done)
+            except self.errors:
+                await self.sleep(t.failed())
+                continue
+            t.begin(start, size)
+            try:
+                while True:
+                    clock = self.clock()
+                    buf = await resp.read(t.chunk)
+                    if not t.received(buf, self.clock() - clock):
+                        break
+            except self.errors:
+                resp.close()
+                await self.sleep(t.failed())
+                continue
+            resp.close()
+            if not t.incomplete():
+                break
+        await asyncio.get_running_loop().run_in_executor(None, t.check) # reads the whole zip back
+        return t.finish()
+
+class AsyncQualtrics_v3():
+    # Same surface as Qualtrics_v3 with coroutines; one instance belongs to one event loop
+    def __init__(self, base_uri, api_token, pool_size=4, timeout=None, scheme="https", workspace_quota=None):
+        # scheme="http" is only meant for talking to a local stand-in server
+        self.version = (3)
+        self.base_uri = base_uri
+        self.scheme = scheme
+        self.token = api_token
+        self.api_url = '/API/v3/'
+        self.headers = {'X-API-TOKEN': api_token}
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pools = {}
+        self.workspace_quota = workspace_quota
+        self._workspace = None
+    def pool(self, host, scheme="https"):
+        if (scheme, host) not in self.pools:
+            self.pools[(scheme, host)] = AsyncConnectionPool(host, size=self.pool_size, timeout=self.timeout, scheme=scheme)
+        return self.pools[(scheme, host)]
+    async def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, *exc):
+        await self.close()
+    async def request(self, method, command, data=None, headers={}):
+        # Returns parsed JSON from Qualtrics; HTTP errors are left to the caller like Qualtrics_v3.request
+        url_req = "{0}://{1}/{2}".format(self.scheme, self.base_uri, self.api_url + command)
+        return await self.request_url(method, url_req, data=data, headers=headers)
+    async def request_url(self, method, url, data=None, headers={}, raw=False):
+        url_parsed = urlparse(url)
+        if url_parsed.scheme.lower() != "https" and url_parsed.scheme.lower() != self.scheme:
+            sys.stdout.write("WARNING: url scheme is not HTTPS!\n")
+        if url_parsed.netloc == "":
+            sys.stdout.write("WARNING: could not detect network location!\n")
+        send_headers = self.headers.copy()
+        send_headers.update(headers)
+        resp = await self.pool(url_parsed.netloc or self.base_uri, url_parsed.scheme.lower()).request(method, url, body=data, headers=send_headers)
+        if raw:
+            return resp
+        async with resp:
+            rt = (await resp.read()).decode('UTF-8')
+        return {"stat_code":resp.status, "status_msg":resp.reason, "data":json.loads(rt)}
+
+    # surveys!
+    async def survey_list(self):
+        return [survey async for survey in self.survey_iter()]
+    async def survey_iter(self):
+        # Async generator over all surveys; the next page is requested before the current one is handed out
+        async def page(url):
+            raw = await self.request_url("GET", url)
+            if raw["stat_code"] != 200:
+                raise qualtrics_error(raw)
+            return raw["data"]["result"]
+        upcoming = asyncio.ensure_future(page("{0}://{1}/{2}".format(self.scheme, self.base_uri, self.api_url + "surveys")))
+        try:
+            while upcoming is not None:
+                result = await upcoming
+                upcoming = asyncio.ensure_future(page(result["nextPage"])) if result["nextPage"] is not None else None
+                for survey in result["elements"]:
+                    yield survey
+        finally:
+            if upcoming is not None:
+                upcoming.cancel()
+    async def survey_get(self, sid):
+        raw = await self.request("GET", "surveys/{0}".format(sid))
+        if raw["stat_code"] != 200:
+            raise qualtrics_error(raw)
+        return raw["data"]["result"]
+
+    # response exports!
+    async def export_start(self, sid, etype, last_response_id=None, start_date=None, end_date=None):
+        data = export_request(sid, etype, last_response_id=last_response_id, start_date=start_date, end_date=end_date)
+        rdoc_raw = await self.request("POST", "responseexports", data=data, headers={"Content-Type":"application/json"})
+        if rdoc_raw["stat_code"] != 200:
+            raise qualtrics_error(rdoc_raw)
+        return rdoc_raw['data']['result']['id']
+    async def export_check(self, eid):
+        rc_raw = await self.request("GET", "responseexports/" + eid)
+        if rc_raw["stat_code"] != 200:
+            raise qualtrics_error(rc_raw)
+        return rc_raw['data']['result']
+    async def export_fetch(self, url, etype, callback=print_progress, stream=False, spool_size=64*1024*1024, mmap=False):
+        # The zip is extracted on a worker thread so the event loop keeps running
+        fetch = ExportFetch(self.workspace, etype, stream=stream, spool_size=spool_size, mmap=mmap)
+        try:
+            fetch.stats = await self.response_download(url, fetch.file, callback=callback)
+            extract = asyncio.get_running_loop().run_in_executor(None, fetch.result)
+            try:
+                return await asyncio.shield(extract)
+            except asyncio.CancelledError:
+                # the worker thread can't be stopped; let it finish before its files are removed
+                await asyncio.wait([extract])
+                if not extract.cancelled() and extract.exception() is None and (stream or mmap):
+                    extract.result().close()
+                raise
+        except BaseException:
+            fetch.discard()
+            raise
+        finally:
+            fetch.release()
+    async def response_export(self, sid, etype, poller=None, callback=print_progress, stream=False, spool_size=64*1024*1024,
+            mmap=False, last_response_id=None, start_date=None, end_date=None):
+        # Like Qualtrics_v3.response_export; the waits between progress checks don't block the event loop
+        if poller is None:
+            poller = ExportPoller()
+        rdoc_id = await self.export_start(sid, etype, last_response_id=last_response_id, start_date=start_date, end_date=end_date)
+        poller.start()
+        while True:
+            result = await self.export_check(rdoc_id)
+            rc_progress = result['percentComplete']
+            callback("export", rc_progress, 100)
+            if rc_progress >= 100:
+                break
+            await asyncio.sleep(poller.next_interval(rc_progress))
+        return await self.export_fetch(result['file'], etype, callback=callback, stream=stream, spool_size=spool_size, mmap=mmap)
+    async def response_download(self, url, f, callback=print_progress, downloader=None):
+        # See Qualtrics_v3.response_download
+        if downloader is None:
+            downloader = AsyncDownloader(self)
+        return await downloader.download(url, f, callback)
+    async def response_export_many(self, sids, etype, concurrency=4, poller=ExportPoller, callback=print_survey_progress, **kwargs):
+        # Exports several surveys on this event loop, at most `concurrency` at a time; returns {sid: result}
+        slots = asyncio.Semaphore(concurrency)
+        async def export(sid):
+            async with slots:
+                return await self.response_export(sid, etype, poller=poller(), callback=lambda *a: callback(sid, *a), **kwargs)
+        tasks = [asyncio.ensure_future(export(sid)) for sid in sids]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # stop the other exports and don't leak the open downloads that did finish (see Qualtrics_v3)
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if kwargs.get("stream") or kwargs.get("mmap"):
+                for t in tasks:
+                    if not t.cancelled() and t.exception() is None:
+                        t.result().close()
+            raise
+        return dict(zip(sids, results))
+
+    @property
+    def workspace(self):
+        # See Qualtrics_v3.workspace
+        if self._workspace is None or self._workspace.closing:
+            self._workspace = Workspace(quota=self.workspace_quota)
+        return self._workspace
+    def response_clean(self):
+        # Only touches local files, so it runs synchronously
+        if self._workspace is not None:
+            self._workspace.close()
+            self._workspace = None
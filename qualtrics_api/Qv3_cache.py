@@ -0,0 +1,251 @@
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError: # Windows: only threads of this process are kept apart
+    fcntl = None
+
+from qualtrics_api.Qv3_store import RID, ResponseStore
+from qualtrics_api.Qv3_stream import iter_responses, write_responses
+
+class ExportCache:
+    # Content-addressed on-disk cache of survey definitions and response exports
+    # Blobs live in <root>/blobs/<sha256>; <root>/index.json maps cache keys to blobs along with their size and last access.
+    # Survey definitions expire after `ttl` seconds, exports are keyed by the survey's last-modified date and response
+    # count so they stay valid until the survey changes.  Least recently used entries are evicted above `max_bytes`
+    def __init__(self, root, ttl=3600, max_bytes=2*1024*1024*1024, clock=time.time):
+        self.root = os.path.expanduser(root)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(self.root, "blobs"), exist_ok=True)
+        self.index_path = os.path.join(self.root, "index.json")
+        self.lock_path = os.path.join(self.root, "index.lock")
+
+    @contextlib.contextmanager
+    def locked(self):
+        # Serializes index updates between threads and, with an flock on index.lock, between processes sharing the
+        # cache (e.g. a cron report and an interactive session), so one never collects a blob the other is adding
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    def save_index(self, index):
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".index_")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_path)
+    def blob_path(self, digest):
+        return os.path.join(self.root, "blobs", digest)
+
+    def get(self, key, max_age=None):
+        # Path of the cached blob for key, or None if it is missing or older than max_age seconds
+        with self.locked():
+            index = self.load_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            path = self.blob_path(entry["digest"])
+            now = self.clock()
+            if (max_age is not None and now - entry["created"] > max_age) or not os.path.isfile(path):
+                del index[key]
+                self.collect(index)
+                self.save_index(index)
+                return None
+            entry["accessed"] = now
+            self.save_index(index)
+            return path
+    def entry(self, key):
+        with self.locked():
+            return self.load_index().get(key)
+    def annotate(self, key, **meta):
+        # Adds metadata to an existing entry
+        with self.locked():
+            index = self.load_index()
+            if key in index:
+                index[key].update(meta)
+                self.save_index(index)
+    def put(self, key, fileobj, meta={}):
+        # Copies the binary file object into the cache under key and returns the blob path
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".blob_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    buf = fileobj.read(1024*1024)
+                    if not buf:
+                        break
+                    sha.update(buf)
+                    size += len(buf)
+                    f.write(buf)
+            digest = sha.hexdigest()
+            path = self.blob_path(digest)
+            with self.locked(): # the blob is moved in and indexed in one step
+                os.replace(tmp, path) # identical content lands on the same blob
+                index = self.load_index()
+                now = self.clock()
+                index[key] = dict(meta, digest=digest, size=size, created=now, accessed=now)
+                self.evict(index, keep=key)
+                self.save_index(index)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return path
+
+    def evict(self, index, keep=None):
+        # Drops least recently used entries until the unique blobs fit in max_bytes
+        blobs = {}
+        for entry in index.values():
+            blobs[entry["digest"]] = entry["size"]
+        total = sum(blobs.values())
+        for key in sorted(index, key=lambda k: index[k]["accessed"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            digest = index.pop(key)["digest"]
+            if digest in blobs and not any(e["digest"] == digest for e in index.values()):
+                total -= blobs.pop(digest)
+        self.collect(index)
+    def collect(self, index):
+        # Removes blobs no longer referenced by the index, and the snapshots of their responses
+        live = set(e["digest"] for e in index.values())
+        for name in os.listdir(os.path.join(self.root, "blobs")):
+            if name not in live:
+                os.remove(self.blob_path(name))
+        snapshots = os.path.join(self.root, "snapshots")
+        if os.path.isdir(snapshots):
+            for name in os.listdir(snapshots):
+                if not name.startswith(".") and name.split("-")[0] not in live: # skip snapshots being written
+                    shutil.rmtree(os.path.join(snapshots, name), ignore_errors=True)
+    def clear(self):
+        with self.locked():
+            shutil.rmtree(os.path.join(self.root, "blobs"))
+            os.makedirs(os.path.join(self.root, "blobs"))
+            self.save_index({})
+
+    # Qualtrics helpers
+    def survey(self, q, sid, max_age=-1, refresh=False):
+        # Survey definition from the cache, fetched with q.survey_get when missing, expired or refresh is set
+        # max_age defaults to the cache TTL; pass None to accept any cached definition
+        key = "survey/{0}".format(sid)
+        path = None if refresh else self.get(key, max_age=self.ttl if max_age == -1 else max_age)
+        if path is None:
+            data = q.survey_get(sid)
+            self.put(key, io.BytesIO(json.dumps(data).encode("UTF-8")))
+            return data
+        with open(path) as f:
+            return json.load(f)
+    def export_key(self, survey, etype):
+        counts = survey.get('responseCounts', {})
+        return "export/{0}/{1}/{2}/{3}".format(survey['id'], survey.get('lastModifiedDate'), counts.get('auditable'), etype)
+    def export(self, q, survey, etype="json", refresh=False, **kwargs):
+        # Binary file object on the exported responses, downloaded with q.response_export only if not cached
+        key = self.export_key(survey, etype)
+        path = None if refresh else self.get(key)
+        if path is None:
+            with q.response_export(survey['id'], etype, stream=True, **kwargs) as reader:
+                path = self.put(key, reader, meta={"name": reader.name})
+        return open(path, "rb")
+    def export_many(self, q, surveys, etype="json", refresh=False, concurrency=4, **kwargs):
+        # export() for several surveys: the ones not cached are exported together with q.response_export_many
+        # Returns {survey ID: binary file object}
+        files = {}
+        missing = []
+        for survey in surveys:
+            path = None if refresh else self.get(self.export_key(survey, etype))
+            if path is None:
+                missing.append(survey)
+            else:
+                files[survey['id']] = open(path, "rb")
+        if missing:
+            readers = q.response_export_many([survey['id'] for survey in missing], etype, concurrency=concurrency, stream=True, **kwargs)
+            for survey in missing:
+                with readers[survey['id']] as reader:
+                    path = self.put(self.export_key(survey, etype), reader, meta={"name": reader.name})
+                files[survey['id']] = open(path, "rb")
+        return {survey['id']: files[survey['id']] for survey in surveys}
+    def store(self, path, survey, columns=None):
+        # ResponseStore of the cached JSON export at path (as returned by export() or sync())
+        # The parsed store is snapshotted next to the blob (see ResponseStore.save), so later loads of the same export
+        # memory-map the snapshot in milliseconds instead of parsing the JSON again
+        tag = json.dumps([survey.get('lastModifiedDate'), sorted(columns) if columns is not None else None])
+        name = "{0}-{1}".format(os.path.basename(path), hashlib.sha256(tag.encode("UTF-8")).hexdigest()[:16])
+        snapshot = os.path.join(self.root, "snapshots", name)
+        if os.path.isdir(snapshot):
+            try:
+                return ResponseStore.load(snapshot)
+            except (RuntimeError, OSError, ValueError, KeyError):
+                shutil.rmtree(snapshot, ignore_errors=True) # unreadable (e.g. older format); parse again
+        with open(path, "rb") as f:
+            store = ResponseStore(survey, iter_responses(f), columns=columns)
+        with self.locked(): # another process may be snapshotting the same export
+            if not os.path.isdir(snapshot):
+                store.save(snapshot)
+        return store
+    def latest_export(self, sid, etype):
+        # Key of the most recently cached export of survey sid in format etype, or None
+        prefix = "export/{0}/".format(sid)
+        suffix = "/{0}".format(etype)
+        with self.locked():
+            index = self.load_index()
+        keys = [k for k in index if k.startswith(prefix) and k.endswith(suffix)]
+        if not keys:
+            return None
+        return max(keys, key=lambda k: index[k]["created"])
+    def sync(self, q, survey, etype="json", refresh=False, **kwargs):
+        # Like export(), but an older cached export of the same survey is brought up to date with an incremental export
+        # of the responses after its last one instead of downloading everything again
+        # Returns (file object on the full export, list of responses added since the cached export); the list is
+        # None when the whole export had to be downloaded
+        key = self.export_key(survey, etype)
+        path = None if refresh else self.get(key)
+        if path is not None:
+            return open(path, "rb"), []
+        prev = None if refresh else self.latest_export(survey['id'], etype)
+        prev_path = self.get(prev) if prev is not None else None
+        if prev_path is None:
+            return self.export(q, survey, etype, refresh=True, **kwargs), None
+        last = self.entry(prev).get("last_response_id")
+        if last is None:
+            with open(prev_path, "rb") as f:
+                for resp in iter_responses(f):
+                    last = resp[RID]
+            self.annotate(prev, last_response_id=last)
+        if last is None: # the cached export is empty, there is nothing to build on
+            return self.export(q, survey, etype, refresh=True, **kwargs), None
+        with q.response_export(survey['id'], etype, stream=True, last_response_id=last, **kwargs) as reader:
+            delta = list(iter_responses(reader))
+        new_rids = set(resp[RID] for resp in delta)
+        with open(prev_path, "rb") as old, tempfile.SpooledTemporaryFile(max_size=64*1024*1024) as merged:
+            # responses that come back in the delta replace their cached copy
+            kept = (resp for resp in iter_responses(old) if resp[RID] not in new_rids)
+            write_responses(merged, itertools.chain(kept, delta))
+            merged.seek(0)
+            path = self.put(key, merged, meta={"last_response_id": delta[-1][RID] if delta else last})
+        return open(path, "rb"), delta
@@ -0,0 +1,168 @@
+import http.client as HTC
+import re
+import time
+import zipfile
+import zlib
+
+from qualtrics_api.QualtricsException import QualtricsException
+
+class DownloadStats:
+    # Throughput of one download
+    def __init__(self):
+        self.bytes = 0 # bytes written to the file, counting restarts from zero only once
+        self.received = 0 # bytes read from the network
+        self.seconds = 0.0
+        self.resumes = 0 # times the download continued with a Range request after a dropped connection
+        self.restarts = 0 # times the server ignored the Range request and the download started over
+        self.chunk_size = 0 # chunk size at the end of the download
+    @property
+    def rate(self):
+        # Bytes per second
+        return self.received / self.seconds if self.seconds > 0 else 0.0
+    def __repr__(self):
+        return "<DownloadStats {0} bytes in {1:.2f}s ({2:.2f} MB/s), {3} resumes, {4} restarts>".format(self.bytes,
+            self.seconds, self.rate / 1e6, self.resumes, self.restarts)
+
+class Transfer:
+    # Where one download stands: bytes written, chunk size, failures in a row and stats.  Downloader.download and its
+    # asyncio counterpart (Qv3_async.AsyncDownloader) differ only in how they wait for the network, so both drive this
+    def __init__(self, downloader, f, callback):
+        self.downloader = downloader
+        self.f = f
+        self.callback = callback
+        self.stats = DownloadStats()
+        self.chunk = downloader.min_chunk
+        self.total = -1
+        self.done = 0
+        self.failures = 0
+        self.start_time = downloader.clock()
+
+    def failed(self):
+        # Call from an except block: re-raises once there are too many failures in a row, else returns the backoff
+        self.failures += 1
+        if self.failures > self.downloader.retries:
+            raise
+        return self.downloader.backoff * 2 ** (self.failures - 1)
+    def begin(self, start, size):
+        # A response for the rest of the file starting at byte start of size bytes in total
+        if start == 0 and self.done > 0:
+            self.stats.restarts += 1 # no Range support; start over
+            self.f.seek(0)
+            self.f.truncate()
+            self.done = 0
+        elif self.done > 0:
+            self.stats.resumes += 1
+        if self.total < 0:
+            self.total = size
+    def received(self, buf, elapsed):
+        # Writes a chunk that took elapsed seconds to read and adapts the chunk size; False at the end of the response
+        if not buf:
+            return False
+        d = self.downloader
+        self.f.write(buf)
+        self.done += len(buf)
+        self.stats.received += len(buf)
+        self.failures = 0
+        self.callback("download", self.done, self.total)
+        if len(buf) == self.chunk and elapsed < d.target / 2:
+            self.chunk = min(self.chunk * 2, d.max_chunk)
+        elif elapsed > d.target:
+            self.chunk = max(self.chunk // 2, d.min_chunk)
+        return True
+    def incomplete(self):
+        # Whether to resume after the server closed the connection early without an error
+        if self.total < 0 or self.done >= self.total:
+            return False
+        self.failures += 1
+        return self.failures <= self.downloader.retries
+    def check(self):
+        # Blocks while a zip is checked
+        self.stats.seconds = self.downloader.clock() - self.start_time
+        self.stats.bytes = self.done
+        self.stats.chunk_size = self.chunk
+        if self.total >= 0 and self.done != self.total:
+            raise QualtricsException("Export download is {0} bytes, expected {1}".format(self.done, self.total))
+        self.downloader.validate(self.f)
+    def finish(self):
+        self.callback("downloaded", self.done, self.total)
+        return self.stats
+
+class Downloader:
+    # Downloads a file over a Qualtrics_v3 connection pool in adaptively sized chunks
+    # The chunk size doubles while chunks arrive faster than target/2 seconds and halves when one takes longer than
+    # target, within [min_chunk, max_chunk].  A dropped connection is resumed where it stopped with an HTTP Range
+    # request (up to `retries` times in a row, with exponential backoff).  The result is checked against the
+    # Content-Length and, for zip files, against the CRC of every member
+    errors = (HTC.HTTPException, OSError) # a dropped connection
+    def __init__(self, q, min_chunk=64*1024, max_chunk=8*1024*1024, target=0.25, retries=5, backoff=0.5,
+            clock=time.monotonic, sleep=time.sleep):
+        self.q = q
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.target = target
+        self.retries = retries
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+
+    def range(self, offset):
+        return {"Range": "bytes={0}-".format(offset)} if offset else {}
+    def opened(self, resp, offset):
+        # The response and the offset it actually starts at, and the size of the whole file (-1 if unknown)
+        if resp.status == 206:
+            match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", resp.getheader("Content-Range", ""))
+            start = int(match.group(1)) if match else -1
+            total = int(match.group(2)) if match and match.group(2) != "*" else -1
+            if start != offset:
+                resp.close()
+                raise QualtricsException("Server resumed the download at byte {0} instead of {1}".format(start, offset))
+            return resp, start, total
+        if resp.status == 200:
+            return resp, 0, int(resp.getheader("Content-Length", -1))
+        resp.close()
+        raise QualtricsException("Export download failed: HTTP {0} {1}".format(resp.status, resp.reason))
+    def open(self, url, offset):
+        # Response for the rest of the file from offset (see opened)
+        return self.opened(self.q.request_url("GET", url, headers=self.range(offset), raw=True), offset)
+
+    def download(self, url, f, callback):
+        # Copies url into the seekable binary file f (read access is needed to check zips); returns DownloadStats
+        t = Transfer(self, f, callback)
+        while True:
+            try:
+                resp, start, size = self.open(url, t.done)
+            except self.errors:
+                self.sleep(t.failed())
+                continue
+            t.begin(start, size)
+            try:
+                while True:
+                    clock = self.clock()
+                    buf = resp.read(t.chunk)
+                    if not t.received(buf, self.clock() - clock):
+                        break
+            except self.errors:
+                resp.close()
+                self.sleep(t.failed())
+                continue
+            resp.close()
+            if not t.incomplete():
+                break
+        t.check()
+        return t.finish()
+
+    def validate(self, f):
+        # Checks the CRC of every member when the file is a zip
+        f.flush()
+        f.seek(0)
+        if not zipfile.is_zipfile(f):
+            f.seek(0, 2)
+            return
+        try:
+            with zipfile.ZipFile(f) as z:
+                bad = z.testzip()
+        except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+            raise QualtricsException("Export download is corrupt: {0}".format(e))
+        if bad is not None:
+            raise QualtricsException("Export download is corrupt: CRC mismatch in {0}".format(bad))
+        f.seek(0, 2)
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+
+# Predicates on the answers of a response, for restricting an analysis to a segment of the respondents, e.g.
+#   In("Q2.1", ["1", "2"]) & ~AnySelected("Q2.5", ["1"])
+#   Range("Q5.1_3", low=4) | AllSelected("Q3.1", ["2", "5"])
+# A predicate evaluates to a bool array over the store's responses in a few vectorized operations per column, and
+# anything that takes where= (QHelpers, Nars, ResponseStore counts, run_graphs) accepts a predicate, a bool
+# array in store order, or a bool Series indexed by ResponseID like hasq_in_val returns
+
+class Predicate:
+    def mask(self, store):
+        # Bool array of the responses in store that satisfy the predicate
+        raise NotImplementedError
+    def __and__(self, other):
+        return And(self, other)
+    def __or__(self, other):
+        return Or(self, other)
+    def __invert__(self):
+        return Not(self)
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, ", ".join(repr(a) for a in self.args()))
+    def args(self):
+        return ()
+
+class In(Predicate):
+    # Answer to col is one of values (choice codes or text, compared like hasq_in_val)
+    def __init__(self, col, values):
+        self.col = col
+        self.values = list(values)
+    def args(self):
+        return (self.col, self.values)
+    def mask(self, store):
+        return store.isin(self.col, self.values)
+
+class NotIn(In):
+    # col was answered, with none of values
+    def mask(self, store):
+        return store.answered(self.col) & ~store.isin(self.col, self.values)
+
+class Range(Predicate):
+    # Numeric answer to col between low and high inclusive; either bound may be None
+    def __init__(self, col, low=None, high=None):
+        self.col = col
+        self.low = low
+        self.high = high
+    def args(self):
+        return (self.col, self.low, self.high)
+    def mask(self, store):
+        values = store.values(self.col)
+        result = np.isfinite(values)
+        if self.low is not None:
+            result &= values >= self.low
+        if self.high is not None:
+            result &= values <= self.high
+        return result
+
+class Answered(Predicate):
+    # col (or any choice of an MA question) was answered
+    def __init__(self, col):
+        self.col = col
+    def args(self):
+        return (self.col,)
+    def mask(self, store):
+        return store.answered(self.col)
+
+class AnySelected(Predicate):
+    # At least one of choices (sub-columns or choice keys) of the MA question qcol was selected
+    def __init__(self, qcol, choices):
+        self.qcol = qcol
+        self.choices = list(choices)
+    def args(self):
+        return (self.qcol, self.choices)
+    def mask(self, store):
+        return store.any_selected(self.qcol, self.choices)
+
+class AllSelected(AnySelected):
+    # Every one of choices was selected
+    def mask(self, store):
+        return store.all_selected(self.qcol, self.choices)
+
+class OnlySelected(AnySelected):
+    # Nothing outside choices was selected
+    def mask(self, store):
+        return store.only_selected(self.qcol, self.choices)
+
+class And(Predicate):
+    def __init__(self, *predicates):
+        self.predicates = []
+        for p in predicates: # keeps a & b & c flat
+            self.predicates += p.predicates if type(p) is type(self) else [p]
+    def args(self):
+        return tuple(self.predicates)
+    def mask(self, store):
+        result = np.ones(store.N, dtype=bool)
+        for p in self.predicates:
+            result &= p.mask(store)
+        return result
+
+class Or(And):
+    def mask(self, store):
+        result = np.zeros(store.N, dtype=bool)
+        for p in self.predicates:
+            result |= p.mask(store)
+        return result
+
+class Not(Predicate):
+    def __init__(self, predicate):
+        self.predicate = predicate
+    def args(self):
+        return (self.predicate,)
+    def mask(self, store):
+        return ~self.predicate.mask(store)
+
+def selection(store, where):
+    # where as a bool array in store order, or None when it selects every response
+    if where is None:
+        return None
+    if isinstance(where, Predicate):
+        rows = where.mask(store)
+    elif isinstance(where, pd.Series):
+        rows = where.reindex(store.index, fill_value=False).to_numpy(dtype=bool)
+    else:
+        rows = np.asarray(where, dtype=bool)
+    if rows.shape != (store.N,):
+        raise RuntimeError("where selects {0} rows, but there are {1} responses\n".format(len(rows), store.N))
+    return rows
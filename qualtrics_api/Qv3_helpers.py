@@ -2,80 +2,47 @@ import numpy as np
 import pandas as pd
 import sys
 
+from qualtrics_api.Qv3_filter import In, Or, selection
+from qualtrics_api.Qv3_stats import crosstab
+from qualtrics_api.Qv3_store import ResponseStore
 import settings
 
 class QHelpers:
-    def __init__(self, qualtrics_object, survey_data):
+    # Every method that reads the responses takes where= to restrict it to a segment (see Qv3_filter)
+    def __init__(self, qualtrics_object, survey_data, store=None):
         self.q = qualtrics_object
-        self.survey = self.q.survey_get(settings.qualtrics_survey)
+        if store is None:
+            store = ResponseStore(self.q.survey_get(settings.qualtrics_survey), survey_data['responses'])
+        self.survey = store.survey
+        self.schema = store.schema
         self.survey_data = survey_data
-        self.N = len(self.survey_data['responses'])
-    def mc2list(self, qcol, percent=False):
-        try:
-            qid = self.survey['exportColumnMap'][qcol]['question']
-            question = self.survey['questions'][qid]
-        except KeyError:
-            raise RuntimeError("{0} is not a multiple choice, single-answer question\n".format(qcol))
-        if question['questionType']['type'] == "MC" and (question['questionType']['selector'] == "SAVR" or question['questionType']['selector'] == "SAHR"):
-            matrix=False
-        elif question['questionType']['type'] == "Matrix" and question['questionType']['subSelector'] == "SingleAnswer":
-            matrix=True
-        else:
-            raise RuntimeError("{0} is not a multiple choice, single-answer type question\n".format(qcol))
-            return None
-        n=0
-        choices = question['choices']
-        ck = sorted(choices.keys(), key=int)
-        data = pd.Series([0]*len(ck), name=qcol, index=ck, dtype=int)
-        for i in self.survey_data['responses']:
-            ans = i[qcol]
-            if ans == "":
-                pass # Throw out questions they didn't answer
-            else:
-                n+=1
-                data[ans] += 1
+        self.store = store
+    @property
+    def N(self):
+        return self.store.N
+    def mc2list(self, qcol, percent=False, where=None):
+        info = self.schema.mc(qcol)
+        ck = info.choice_keys
+        counts = self.store.counts(qcol, where=where) # Throws out questions they didn't answer
+        n = counts.sum()
+        data = pd.Series([counts[int(k)] if int(k) < len(counts) else 0 for k in ck], name=qcol, index=ck, dtype=int)
         if percent:
             if n > 0:
                 data = data.apply(lambda x:x/n)
-        names = []
-        keys = data.index
-        for i in keys:
-            if not matrix:
-                names.append(choices[i]['choiceText'])
-            else:
-                names.append(choices[i]['description'])
-        data.index = names
+        data.index = info.choice_labels
         return data
 
-    def ma2list(self, qcol): #Compiles the raw respondants from a multiple-choice-multiple-answer question
-        qcols = {}
-        for i in self.survey['exportColumnMap'].keys():
-            if i.startswith(qcol+"_"):
-                if i.endswith("_TEXT"):
-                    continue
-                try:
-                    qcols[i] = self.survey['exportColumnMap'][i]['choice'].split(".")
-                except KeyError:
-                    raise RuntimeError("{0} is not a multiple choice-multiple answer question\n".format(qcol))
-        qn = sorted(qcols.keys(), key=lambda k: int(qcols[k][2]))
-        qid = self.survey['exportColumnMap'][qn[0]]['question']
-        question = self.survey['questions'][qid]
-        if question['questionType']['type'] != "MC" and question['questionType']['selector'] != "MAVR":
-            raise RuntimeError("{0} is not a multiple choice-multiple answer question\n".format(qcol))
-            return None
-        choices = question['choices']
-        data = pd.Series([0]*len(qn), name=qcol, index=qn, dtype=int)
-        for i in self.survey_data['responses']:
-            for j in i:
-                if j in qn:
-                    ans = i[j]
-                    if (ans):
-                        data[j] += 1
-        names = []
-        for i in qn:
-            c = qcols[i][2]
-            names.append(choices[c]['choiceText'])
-        data.index = names
+    def ma2list(self, qcol, where=None): #Compiles the raw respondants from a multiple-choice-multiple-answer question
+        info = self.schema.ma(qcol)
+        data = pd.Series(self.store.bitcounts(qcol, where=where), name=qcol, index=info.column_labels, dtype=int)
+        return data
+    def ma2coselection(self, qcol, where=None): # How many respondents picked each pair of choices together; the diagonal is ma2list
+        info = self.schema.ma(qcol)
+        data = pd.DataFrame(self.store.coselection(qcol, where=where), index=info.column_labels, columns=info.column_labels)
+        return data
+    def ma2counts(self, qcol, where=None): # How many respondents picked 0, 1, 2, ... of the choices
+        info = self.schema.ma(qcol)
+        data = pd.Series(np.bincount(self.store.popcounts(qcol, where=where), minlength=len(info.columns) + 1), name=qcol, dtype=int)
         return data
 
     def list_grouper(self, *args):
@@ -83,104 +50,78 @@ class QHelpers:
         r = r.transpose()
         return r
 
-    def mcpaired(self, qcol1, qcol2):
-        qid1 = self.survey['exportColumnMap'][qcol1]['question']
-        qid2 = self.survey['exportColumnMap'][qcol2]['question']
-        question1 = self.survey['questions'][qid1]
-        question2 = self.survey['questions'][qid2]
-        if not (question1['questionType']['type'] == "MC" and (question1['questionType']['selector'] == "SAVR" or question1['questionType']['selector'] == "SAHR")):
+    def mcpaired(self, qcol1, qcol2, where=None):
+        info1 = self.schema.question(qcol1)
+        info2 = self.schema.question(qcol2)
+        if not (info1.type == "MC" and (info1.selector == "SAVR" or info1.selector == "SAHR")):
             sys.stderr.write("{0} is not a multiple choice, single-answer question\n".format(qcol1))
             return None
-        if not (question2['questionType']['type'] == "MC" and (question2['questionType']['selector'] == "SAVR" or question2['questionType']['selector'] == "SAHR")):
+        if not (info2.type == "MC" and (info2.selector == "SAVR" or info2.selector == "SAHR")):
             sys.stderr.write("{0} is not a multiple choice, single-answer question\n".format(qcol2))
             return None
-        choices1 = question1['choices']
-        choices2 = question2['choices']
-        s1 = np.array([np.NaN]*self.N)
-        s2 = np.array([np.NaN]*self.N)
-        rids = []
-        for i,j in zip(self.survey_data['responses'], range(self.N)):
-            s1[j] = i[qcol1]
-            s2[j] = i[qcol2]
-            rids.append(i['ResponseID'])
-        data = pd.DataFrame(index=rids)
-        data[qcol1] = s1
-        data[qcol2] = s2
-        names1 = []
-        keys1 = sorted(choices1.keys(), key=int)
-        for i in keys1:
-            names1 += [choices1[i]['choiceText']]
-        names2 = []
-        keys2 = sorted(choices2.keys(), key=int)
-        for i in keys2:
-            names2 += [choices2[i]['choiceText']]
-        return {"pairs":data, "keys1":keys1,"keys2":keys2, "names1":names1,"names2":names2}
+        rows = selection(self.store, where)
+        if rows is None:
+            rows = slice(None)
+        data = pd.DataFrame(index=self.store.index[rows])
+        data[qcol1] = self.store.values(qcol1)[rows]
+        data[qcol2] = self.store.values(qcol2)[rows]
+        return {"pairs":data, "keys1":info1.choice_keys,"keys2":info2.choice_keys, "names1":info1.choice_labels,"names2":info2.choice_labels}
 
-    def pairs2list(self, mcp):
+    def pairs2list(self, mcp, weights=None, where=None):
+        # weights like crosstab: a Series indexed by ResponseID or an array in store order
         pairs = mcp['pairs']
+        rows = selection(self.store, where)
+        if rows is not None:
+            pairs = pairs[pairs.index.isin(self.store.index[rows])]
         k1 = list(map(int, mcp['keys1']))
         k2 = list(map(int, mcp['keys2']))
-        cname1 = pairs.columns[0]
-        cname2 = pairs.columns[1]
-        group = pairs.groupby(cname2)
-        data = pd.DataFrame(index=k1)
-        for i in range(len(k2)):
-            k = k2[i]
-            subset = group.get_group(k)[cname1]
-            sums = pd.Series([0]*len(k1), index=k1)
-            for i in range(len(k1)):
-                ik = k1[i]
-                bools = subset == ik
-                sums[ik] = bools.sum()
-            data[k] = sums
-        data.index = mcp['names1']
-        data.columns = mcp['names2']
+        if isinstance(weights, pd.Series):
+            weights = weights.reindex(pairs.index).to_numpy()
+        elif weights is not None:
+            weights = np.asarray(weights, dtype=float)
+            if weights.shape != (self.store.N,):
+                raise RuntimeError("{0} weights given, but there are {1} responses\n".format(len(weights), self.store.N))
+            weights = weights[self.store.index.get_indexer(pairs.index)]
+        table = crosstab([pairs.iloc[:, 0].to_numpy(), pairs.iloc[:, 1].to_numpy()], [k1, k2], weights=weights)
+        data = pd.DataFrame(table, index=mcp['names1'], columns=mcp['names2'])
         return data
 
-    def mcmatrix(self, qcol):
-        qcols = {}
-        for i in self.survey['exportColumnMap'].keys():
-            if i.startswith(qcol+"_"):
-                if i.endswith("_TEXT"):
-                    continue
-                try:
-                    qcols[i] = self.survey['exportColumnMap'][i]['subQuestion'].split(".")
-                except KeyError:
-                    raise RuntimeError("{0} is not a multiple choice matrix question\n".format(qcol))
-        qn = sorted(qcols.keys(), key=lambda k: int(qcols[k][2]))
-        qid = self.survey['exportColumnMap'][qn[0]]['question']
-        question = self.survey['questions'][qid]
-        if question['questionType']['type'] != "Matrix" and question['questionType']['subSelector'] != "SingleAnswer":
-            raise RuntimeError("{0} is not a multiple choice matrix question\n".format(qcol))
-            return None
-        choices = question['choices']
-        sub_questions = question['subQuestions']
+    def crosstab(self, qcols, weights=None, where=None):
+        # Counts every combination of answers to the single-answer questions in qcols (or sums weights, a Series indexed
+        # by ResponseID or an array in store order).  Two questions give a DataFrame, any other number a Series indexed
+        # by the combinations of choice labels
+        infos = [self.schema.mc(q) for q in qcols]
+        if isinstance(weights, pd.Series):
+            weights = weights.reindex(self.store.index).to_numpy()
+        codes = [self.store.codes(q) for q in qcols]
+        rows = selection(self.store, where)
+        if rows is not None:
+            codes = [c[rows] for c in codes]
+            weights = np.asarray(weights)[rows] if weights is not None else None
+        table = crosstab(codes, [list(map(int, i.choice_keys)) for i in infos], weights=weights)
+        if len(qcols) == 2:
+            return pd.DataFrame(table, index=infos[0].choice_labels, columns=infos[1].choice_labels)
+        index = pd.MultiIndex.from_product([i.choice_labels for i in infos], names=list(qcols))
+        return pd.Series(table.ravel(), index=index)
+
+    def mcmatrix(self, qcol, where=None):
+        info = self.schema.matrix(qcol)
         data = pd.DataFrame({})# index=range(len(choices)))
-        for i in qn:
-            row = self.mc2list(i)
+        for i in info.columns:
+            row = self.mc2list(i, where=where)
             data[i] = row
-        qnames = []
-        qkeys = sorted(sub_questions.keys(), key=int)
-        for i in qkeys:
-            qnames += [sub_questions[i]['description']]
-        data.columns = qnames
+        data.columns = info.column_labels
         data = data.transpose()
         return data
 
-    def hasq_in_val(self, qcol, values):
-        rids = []
-        data = pd.Series(np.array([0]*self.N, dtype=np.bool))
-        for i,j in zip(self.survey_data['responses'], range(self.N)):
-            if i[qcol] in values:
-                data[j] = True
-            else:
-                data[j] = False
-            rids.append(i['ResponseID'])
-        data.index = rids
+    def hasq_in_val(self, qcol, values, where=None):
+        return self.segment(In(qcol, values), where)
+    def hasqs_in_val(self, qcols, values, where=None):
+        return self.segment(Or(*[In(i, values) for i in qcols]), where)
+    def segment(self, predicate, where=None):
+        # bool Series (indexed by ResponseID) of the predicate over the responses selected by where
+        data = pd.Series(predicate.mask(self.store), index=self.store.index)
+        rows = selection(self.store, where)
+        if rows is not None:
+            data = data[rows]
         return data
-    def hasqs_in_val(self, qcols, values):
-        acc = False
-        for i in qcols:
-            hq = self.hasq_in_val(i, values)
-            acc |= hq
-        return acc
\ No newline at end of file
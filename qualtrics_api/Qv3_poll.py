@@ -0,0 +1,47 @@
+import random
+import time
+
+from qualtrics_api.QualtricsException import QualtricsException
+
+class ExportPoller:
+    # Schedules the progress checks of a response export
+    # While progress stalls the interval grows exponentially; once progress moves, the interval tracks half the
+    # estimated time remaining.  Every interval gets +/- `jitter` random spread and the whole export is bounded by `timeout`
+    def __init__(self, initial=0.5, maximum=30.0, factor=2.0, jitter=0.1, timeout=1800.0,
+            clock=time.monotonic, sleep=time.sleep, rand=random.random):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.rand = rand
+        self.start()
+    def start(self):
+        self.started = self.clock()
+        self.interval = self.initial
+        self.last = None # (time, progress) of the previous check
+    def eta(self, progress, now):
+        # Seconds until 100% at the progress rate since the previous check, or None if there is no rate yet
+        if self.last is None or progress <= self.last[1] or now <= self.last[0]:
+            return None
+        rate = (progress - self.last[1]) / (now - self.last[0])
+        return (100 - progress) / rate
+    def next_interval(self, progress):
+        now = self.clock()
+        elapsed = now - self.started
+        if elapsed >= self.timeout:
+            raise QualtricsException("Export timed out after {0:.0f}s at {1}%".format(elapsed, progress))
+        eta = self.eta(progress, now)
+        if eta is None:
+            if self.last is not None:
+                self.interval = self.interval * self.factor
+        else:
+            self.interval = eta / 2
+        self.interval = min(max(self.interval, self.initial), self.maximum)
+        self.last = (now, progress)
+        spread = 1 + self.jitter * (2 * self.rand() - 1)
+        return min(self.interval * spread, self.timeout - elapsed)
+    def wait(self, progress):
+        self.sleep(self.next_interval(progress))
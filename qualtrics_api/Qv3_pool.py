@@ -0,0 +1,98 @@
+import http.client as HTC
+import queue
+import select
+import threading
+
+IDEMPOTENT = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+def closed_by_peer(sock):
+    # An idle keep-alive socket that is readable has been closed by the server (or holds stray data): don't reuse it
+    try:
+        readable, writable, errors = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+class ConnectionPool:
+    # Keep-alive connections to a single host, shared between calls and threads
+    # At most `size` connections are checked out at once; idle ones are reused most-recently-used first
+    def __init__(self, host, size=4, timeout=None, connection_class=HTC.HTTPSConnection):
+        self.host = host
+        self.size = size
+        self.timeout = timeout
+        self.connection_class = connection_class
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connection_class(self.host, timeout=self.timeout)
+    def release(self, conn, reuse=True):
+        if reuse:
+            self.idle.put(conn)
+        else:
+            conn.close()
+        self.slots.release()
+    def request(self, method, url, body=None, headers={}):
+        # Returns a PooledResponse; the connection goes back to the pool once the body has been read
+        # A reused keep-alive connection the server has dropped is retried on a fresh one if the request can't have
+        # reached the server (it failed while being sent), or if repeating it is harmless (an idempotent method).
+        # A POST that fails while waiting for the response is not sent again, since it may have started a job
+        while True:
+            conn = self.acquire()
+            reused = conn.sock is not None
+            if reused and closed_by_peer(conn.sock):
+                self.release(conn, reuse=False)
+                continue
+            sent = False
+            try:
+                conn.request(method, url, body=body, headers=headers)
+                sent = True
+                resp = conn.getresponse()
+            except (HTC.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.release(conn, reuse=False)
+                if reused and (not sent or method in IDEMPOTENT):
+                    continue
+                raise
+            except BaseException:
+                self.release(conn, reuse=False)
+                raise
+            return PooledResponse(self, conn, resp)
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+class PooledResponse:
+    # Wraps an HTTPResponse so the underlying connection is handed back to its pool when the body is done
+    def __init__(self, pool, conn, resp):
+        self.pool = pool
+        self.conn = conn
+        self.resp = resp
+    def __getattr__(self, name):
+        return getattr(self.resp, name)
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def read(self, *args):
+        try:
+            buf = self.resp.read(*args)
+        except BaseException:
+            self.close(reuse=False) # e.g. IncompleteRead after a dropped connection
+            raise
+        if self.resp.isclosed():
+            self.close()
+        return buf
+    def close(self, reuse=True):
+        if self.conn is None:
+            return
+        # Only a fully-read response leaves the connection in a usable state
+        reuse = reuse and self.resp.isclosed() and not self.resp.will_close
+        self.resp.close()
+        self.pool.release(self.conn, reuse=reuse)
+        self.conn = None
@@ -0,0 +1,92 @@
+MULTIPLE_ANSWER_SELECTORS = ("MAVR", "MAHR", "MACOL", "MSB")
+
+class QuestionInfo:
+    # Everything the helpers need to know about one export column or question ID, resolved once
+    def __init__(self, qcol, qid, question):
+        self.qcol = qcol
+        self.qid = qid
+        self.question = question
+        qtype = question.get('questionType', {})
+        self.type = qtype.get('type')
+        self.selector = qtype.get('selector')
+        self.sub_selector = qtype.get('subSelector')
+        self.choices = question.get('choices', {})
+        self.choice_keys = sorted(self.choices.keys(), key=int)
+        label = 'description' if self.type == "Matrix" else 'choiceText'
+        self.choice_labels = [self.choices[k].get(label) for k in self.choice_keys]
+        self.columns = [] # sub-columns of MA and matrix questions, in choice/sub-question order
+        self.keys = [] # choice or sub-question key of each sub-column
+        self.column_labels = []
+        self.sub_kind = None # "choice" for multiple-answer sub-columns, "subQuestion" for matrix rows
+
+    def multiple_answer(self):
+        # Choices that are either selected or not; other choice-keyed questions (rank order, constant sum, sliders)
+        # have a value per choice
+        return self.type == "MC" and self.selector in MULTIPLE_ANSWER_SELECTORS
+
+    def single_answer(self):
+        return ((self.type == "MC" and (self.selector == "SAVR" or self.selector == "SAHR")) or
+            (self.type == "Matrix" and self.sub_selector == "SingleAnswer"))
+
+class SurveySchema:
+    # Index over a survey definition's exportColumnMap, built in one pass:
+    # question ID or export column -> QuestionInfo with ordered sub-columns, choice keys and labels
+    def __init__(self, survey):
+        self.survey = survey
+        self.info = {}
+        self.choice_columns = set() # export columns with a value per choice
+        subs = {}
+        for col, ecm in survey['exportColumnMap'].items():
+            if col.endswith("_TEXT"):
+                continue
+            question = survey['questions'].get(ecm['question'], {})
+            self.info[col] = QuestionInfo(col, ecm['question'], question)
+            for kind in ("choice", "subQuestion"):
+                if kind in ecm:
+                    if kind == "choice":
+                        self.choice_columns.add(col)
+                    qcol = col.rsplit("_", 1)[0]
+                    subs.setdefault(qcol, (ecm['question'], kind, []))[2].append((int(ecm[kind].split(".")[2]), col))
+        for qcol, (qid, kind, cols) in subs.items():
+            info = QuestionInfo(qcol, qid, survey['questions'].get(qid, {}))
+            info.sub_kind = kind
+            cols.sort()
+            info.columns = [c for k, c in cols]
+            info.keys = [str(k) for k, c in cols]
+            if kind == "choice":
+                info.column_labels = [info.choices.get(k, {}).get('choiceText') for k in info.keys]
+            else:
+                sub_questions = info.question.get('subQuestions', {})
+                info.column_labels = [sub_questions.get(k, {}).get('description') for k in info.keys]
+            self.info[qcol] = info
+
+    def question(self, qcol):
+        # Raises KeyError for columns that are not in the export
+        return self.info[qcol]
+    def coded(self, col):
+        # Whether the answers to export column col are choice codes, which the store keeps as integers
+        info = self.info.get(col)
+        return info is not None and (info.single_answer() or col in self.choice_columns)
+    def multiple_answer(self):
+        # Question IDs whose sub-columns are multiple-answer choices
+        return [qcol for qcol, info in self.info.items() if info.sub_kind == "choice" and info.multiple_answer()]
+
+    # Lookups that check the question type and raise RuntimeError like the helpers always have
+    def mc(self, qcol):
+        try:
+            info = self.info[qcol]
+        except KeyError:
+            raise RuntimeError("{0} is not a multiple choice, single-answer question\n".format(qcol))
+        if not info.single_answer():
+            raise RuntimeError("{0} is not a multiple choice, single-answer type question\n".format(qcol))
+        return info
+    def ma(self, qcol):
+        info = self.info.get(qcol)
+        if info is None or info.sub_kind != "choice" or not info.multiple_answer():
+            raise RuntimeError("{0} is not a multiple choice-multiple answer question\n".format(qcol))
+        return info
+    def matrix(self, qcol):
+        info = self.info.get(qcol)
+        if info is None or info.sub_kind != "subQuestion" or (info.type != "Matrix" and info.sub_selector != "SingleAnswer"):
+            raise RuntimeError("{0} is not a multiple choice matrix question\n".format(qcol))
+        return info
@@ -0,0 +1,122 @@
+import numpy as np
+
+def key_positions(codes, keys):
+    # Position of each code within keys, and a mask of the codes that appear in keys at all
+    keys = np.asarray(keys, dtype=np.float64)
+    codes = np.asarray(codes, dtype=np.float64)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    if len(keys) == 0:
+        return np.zeros(len(codes), dtype=np.intp), np.zeros(len(codes), dtype=bool)
+    pos = np.clip(np.searchsorted(sorted_keys, codes), 0, len(keys) - 1)
+    hit = sorted_keys[pos] == codes # NaN (unanswered) never matches
+    return order[pos], hit
+
+def crosstab(codes, keys, weights=None):
+    # Contingency table of any number of answer columns in one pass
+    # codes: one array of answer codes per question; keys: the codes to tabulate for each question
+    # Returns an ndarray of shape (len(keys[0]), len(keys[1]), ...) with the number of respondents (or the sum of their
+    # weights) for every combination; combinations nobody picked are 0.  Respondents with an unanswered question, a code
+    # outside keys or a NaN weight are left out
+    shape = tuple(len(k) for k in keys)
+    n = len(codes[0]) if codes else 0
+    valid = np.ones(n, dtype=bool)
+    positions = []
+    for c, k in zip(codes, keys):
+        pos, hit = key_positions(c, k)
+        valid &= hit
+        positions.append(pos)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+        valid &= np.isfinite(weights)
+        weights = weights[valid]
+    size = int(np.prod(shape))
+    if size == 0:
+        return np.zeros(shape, dtype=np.int64 if weights is None else np.float64)
+    flat = np.ravel_multi_index([p[valid] for p in positions], shape)
+    table = np.bincount(flat, weights=weights, minlength=size)
+    return table.reshape(shape)
+
+def grouped_stats(values, membership):
+    # Mean, std (ddof=1), count and standard error of every value column within every group, in one pass
+    # values: N x S float matrix, NaN where missing; membership: N x G bool matrix, and a respondent may be in any number
+    # of groups (e.g. the choices of a multiple-answer question)
+    # Returns a dict of G x S arrays; statistics of groups with too few values are NaN, like pandas
+    values = np.asarray(values, dtype=np.float64)
+    member = np.asarray(membership, dtype=np.float64)
+    present = np.isfinite(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shift = np.where(present, values, 0.0).sum(axis=0) / present.sum(axis=0) # centring keeps the sum of squares accurate
+    shift = np.where(np.isfinite(shift), shift, 0.0)
+    centred = np.where(present, values - shift, 0.0)
+    count = member.T @ present.astype(np.float64)
+    total = member.T @ centred
+    squares = member.T @ (centred ** 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        var = np.maximum(squares - count * mean ** 2, 0.0) / (count - 1)
+        std = np.sqrt(var)
+        std[count < 2] = np.nan
+        sem = std / np.sqrt(count)
+    return {"mean": mean + shift, "std": std, "count": count.astype(np.int64), "sem": sem}
+
+# Kernels on the uint64 bitmasks of multiple-answer questions (bit i set: choice i selected)
+M1 = np.uint64(0x5555555555555555)
+M2 = np.uint64(0x3333333333333333)
+M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+H01 = np.uint64(0x0101010101010101)
+PATTERN_BLOCK = 1 << 16 # patterns expanded into bits at a time, bounding the memory of the kernels below
+
+def popcount(masks):
+    # Number of selected choices of every mask
+    masks = np.asarray(masks, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"): # numpy >= 2.0
+        return np.bitwise_count(masks).astype(np.int64)
+    m = masks - ((masks >> np.uint64(1)) & M1)
+    m = (m & M2) + ((m >> np.uint64(2)) & M2)
+    m = (m + (m >> np.uint64(4))) & M4
+    return ((m * H01) >> np.uint64(56)).astype(np.int64)
+
+def bit_matrix(masks, k):
+    # len(masks) x k bool matrix, column i is bit i
+    masks = np.asarray(masks, dtype=np.uint64)
+    return ((masks[:, np.newaxis] >> np.arange(k, dtype=np.uint64)) & np.uint64(1)).astype(bool)
+
+def bit_patterns(masks, k):
+    # Distinct masks and the number of respondents with each; every count below is computed from these, so the work
+    # after this single pass depends on the number of answer patterns (at most 2**k) instead of the number of responses
+    masks = np.asarray(masks, dtype=np.uint64)
+    if k <= 16:
+        counts = np.bincount(masks.astype(np.intp), minlength=1 << k)
+        patterns = np.flatnonzero(counts)
+        return patterns.astype(np.uint64), counts[patterns]
+    return np.unique(masks, return_counts=True)
+
+def bit_counts(masks, k):
+    # Number of masks with each of the first k bits set
+    patterns, counts = bit_patterns(masks, k)
+    total = np.zeros(k, dtype=np.int64)
+    for start in range(0, len(patterns), PATTERN_BLOCK):
+        block = slice(start, start + PATTERN_BLOCK)
+        total += counts[block] @ bit_matrix(patterns[block], k).astype(np.int64)
+    return total
+
+def coselection(masks, k):
+    # k x k matrix of the number of masks with both bit i and bit j set; the diagonal is bit_counts
+    patterns, counts = bit_patterns(masks, k)
+    total = np.zeros((k, k), dtype=np.int64)
+    for start in range(0, len(patterns), PATTERN_BLOCK):
+        block = slice(start, start + PATTERN_BLOCK)
+        bits = bit_matrix(patterns[block], k).astype(np.int64)
+        total += bits.T @ (bits * counts[block, np.newaxis])
+    return total
+
+def any_set(masks, bits):
+    # Masks sharing at least one bit with bits
+    return (np.asarray(masks, dtype=np.uint64) & np.uint64(bits)) != 0
+def all_set(masks, bits):
+    # Masks with every one of bits set
+    return (np.asarray(masks, dtype=np.uint64) & np.uint64(bits)) == np.uint64(bits)
+def subset_of(masks, bits):
+    # Masks with no bit set outside bits (selecting nothing at all included)
+    return (np.asarray(masks, dtype=np.uint64) & ~np.uint64(bits)) == 0
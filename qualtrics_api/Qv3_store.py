@@ -0,0 +1,394 @@
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from qualtrics_api.Qv3_filter import selection
+from qualtrics_api.Qv3_schema import SurveySchema
+from qualtrics_api.Qv3_stats import all_set, any_set, bit_counts, coselection, popcount, subset_of
+
+MISSING = -1 # answer code for questions the respondent didn't answer
+RID = "ResponseID"
+SID = "SurveyID" # added to the responses of combined stores
+SNAPSHOT_FORMAT = 1
+
+class StringTable:
+    # Strings packed into one NUL-terminated UTF-8 buffer: string i is data[offsets[i]:offsets[i+1]-1]
+    # Snapshots keep response IDs and free text this way, so they can be memory-mapped and decoded only when used.
+    # Columns that hold other JSON values than strings are packed as JSON (loads=True)
+    def __init__(self, data, offsets, loads=False):
+        self.data = data # uint8 array
+        self.offsets = offsets # int64 array of len(self) + 1
+        self.loads = loads
+
+    @classmethod
+    def pack(cls, values):
+        loads = not all(isinstance(v, str) for v in values)
+        encoded = [(json.dumps(v) if loads else v).encode("UTF-8") for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) + 1 for b in encoded], out=offsets[1:])
+        data = np.frombuffer(b"\0".join(encoded) + b"\0" if encoded else b"", dtype=np.uint8)
+        return cls(data, offsets, loads)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+    def __getitem__(self, i):
+        s = bytes(self.data[self.offsets[i]:self.offsets[i+1]-1]).decode("UTF-8")
+        return json.loads(s) if self.loads else s
+    def decode(self):
+        # All strings as an object array
+        n = len(self)
+        parts = bytes(self.data).decode("UTF-8").split("\0") if n else []
+        if len(parts) != n + 1 and n: # some strings contain NULs themselves
+            parts = [self[i] for i in range(n)]
+        elif self.loads:
+            parts = [json.loads(v) for v in parts[:n]]
+        values = np.empty(n, dtype=object)
+        values[:] = parts[:n]
+        return values
+
+class ResponseStore:
+    # Columnar view of a Qualtrics response export, built in a single pass over the responses
+    # Choice answers are stored as small integer codes, multiple-answer questions as one bitmask per respondent
+    def __init__(self, survey, responses, columns=None, schema=None):
+        # responses can be any iterable of response dicts (e.g. Qv3_stream.iter_responses)
+        # If columns is given, only those columns are kept; a question ID such as "Q2.5" selects all of its sub-columns
+        self.survey = survey
+        self.schema = schema if schema is not None else SurveySchema(survey)
+        if columns is not None:
+            columns = set(columns)
+        self.columns = columns
+        self.ma_cols = self._ma_columns(self.schema, columns) # MA question -> ordered sub-columns; bit i of the mask is ma_cols[qcol][i]
+        bits = {}
+        for qcol, cols in self.ma_cols.items():
+            for bit, col in enumerate(cols):
+                bits[col] = (qcol, bit)
+        rids = []
+        raw = None
+        masks = {qcol: [] for qcol in self.ma_cols}
+        for resp in responses:
+            if raw is None:
+                raw = {k: [] for k in resp if k not in bits and k != RID and (columns is None or self.selects(columns, k))}
+            rids.append(resp[RID])
+            for k, lst in raw.items():
+                lst.append(resp.get(k, ""))
+            for qcol, cols in self.ma_cols.items():
+                m = 0
+                for bit, col in enumerate(cols):
+                    if resp.get(col):
+                        m |= 1 << bit
+                masks[qcol].append(m)
+        coded = {}
+        texts = {}
+        for k, lst in (raw or {}).items():
+            codes = self._encode(lst) if self.schema.coded(k) else None # free text stays text, even if it looks numeric
+            if codes is None:
+                texts[k] = np.array(lst, dtype=object)
+            else:
+                coded[k] = codes
+        self._assign(rids, coded, texts, {qcol: np.array(m, dtype=np.uint64) for qcol, m in masks.items()})
+
+    @classmethod
+    def from_columns(cls, survey, rids, coded, texts={}, masks={}):
+        # Builds a store from already-columnar data (code arrays, text arrays and uint64 masks)
+        store = cls.__new__(cls)
+        store.survey = survey
+        store.columns = None
+        store.schema = SurveySchema(survey)
+        store.ma_cols = store._ma_columns(store.schema)
+        store._assign(rids, dict(coded), dict(texts), dict(masks))
+        return store
+
+    @classmethod
+    def combined(cls, surveys, exports, columns=None):
+        # One store over several surveys that share a question layout, e.g. the same survey run for several classes
+        # exports holds one iterable of response dicts per survey; the schema comes from the first survey and the
+        # SurveyID text column records which survey each response came from
+        if columns is not None:
+            columns = set(columns) | {SID}
+        responses = ({**resp, SID: survey['id']} for survey, export in zip(surveys, exports) for resp in export)
+        return cls(surveys[0], responses, columns=columns)
+
+    def selects(self, columns, col):
+        return col in columns or col.rsplit("_", 1)[0] in columns
+
+    def _ma_columns(self, schema, columns=None):
+        # Only MC multiple-answer questions become bitmasks, and only the ones columns keeps
+        ma_cols = {}
+        for qcol in schema.multiple_answer():
+            cols = list(schema.question(qcol).columns)
+            if columns is not None and not any(self.selects(columns, c) for c in cols):
+                continue
+            ma_cols[qcol] = cols
+            if len(cols) > 64:
+                raise RuntimeError("{0} has more than 64 choices and cannot be stored as a bitmask\n".format(qcol))
+        return ma_cols
+
+    def _assign(self, rids, coded, texts, masks):
+        # rids (and text columns) may be StringTables, which are decoded when first used
+        self.N = len(rids)
+        self._rids = rids if isinstance(rids, StringTable) else np.asarray(rids, dtype=object)
+        self._index = None
+        self._positions = None
+        self.coded = coded
+        self.texts = texts
+        self.masks = masks
+        for qcol in self.ma_cols:
+            self.masks.setdefault(qcol, np.zeros(self.N, dtype=np.uint64))
+        self.version = 0 # bumped by every change to the data
+        self.epoch = 0 # bumped when stored rows change in place, which invalidates incremental aggregates
+        self.aggregates = {}
+
+    @property
+    def rids(self):
+        if isinstance(self._rids, StringTable):
+            self._rids = self._rids.decode()
+        return self._rids
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = pd.Index(self.rids)
+        return self._index
+    @property
+    def positions(self): # ResponseID -> row
+        if self._positions is None:
+            self._positions = {rid: i for i, rid in enumerate(self.rids)}
+        return self._positions
+
+    def append(self, responses):
+        # Adds responses (e.g. the delta of an incremental export) and returns how many were read
+        # Responses whose ResponseID is already stored replace the stored answers
+        delta = ResponseStore(self.survey, responses, columns=self.columns, schema=self.schema)
+        if delta.N == 0:
+            return 0
+        for col in list(self.coded):
+            if col in delta.texts: # the new answers aren't choice codes, so neither is the column
+                self.texts[col] = self.text(col)
+                del self.coded[col]
+        known = np.fromiter((rid in self.positions for rid in delta.rids), dtype=bool, count=delta.N)
+        fresh = ~known
+        rows = np.array([self.positions[rid] for rid in delta.rids[known]], dtype=np.intp)
+        def merge(old, new):
+            merged = np.concatenate([old, new[fresh].astype(old.dtype)])
+            merged[rows] = new[known]
+            return merged
+        for col, codes in self.coded.items():
+            new = delta.coded.get(col, np.full(delta.N, MISSING, dtype=np.int8))
+            self.coded[col] = merge(codes.astype(np.result_type(codes, new)), new)
+        for col in list(self.texts):
+            if col in delta.texts or col in delta.coded:
+                new = delta.text(col)
+            else:
+                new = np.full(delta.N, "", dtype=object)
+            self.texts[col] = merge(self.text(col), new)
+        for qcol, masks in self.masks.items():
+            self.masks[qcol] = merge(masks, delta.masks[qcol])
+        for rid in delta.rids[fresh]:
+            self.positions[rid] = len(self.positions)
+        self._rids = np.concatenate([self.rids, delta.rids[fresh]])
+        self._index = None
+        self.N = len(self.rids)
+        self.version += 1
+        if known.any():
+            self.epoch += 1
+        return delta.N
+
+    def save(self, path):
+        # Writes a snapshot of the store to the directory path, replacing any previous one:
+        #   manifest.json  layout: response count, kept columns and the file of every column
+        #   survey.json    the survey definition the schema is built from
+        #   *.npy          answer codes and MA bitmasks, and response IDs and free text as string tables
+        # Load it back with ResponseStore.load
+        path = os.path.abspath(path)
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent, prefix=".snapshot_")
+        try:
+            def save_array(name, arr):
+                np.save(os.path.join(tmp, name), arr)
+                return name
+            def save_strings(name, values):
+                table = values if isinstance(values, StringTable) else StringTable.pack(values)
+                save_array(name + ".data.npy", table.data)
+                save_array(name + ".offsets.npy", table.offsets)
+                return {"name": name, "json": table.loads}
+            manifest = {"format": SNAPSHOT_FORMAT, "N": self.N, "columns": sorted(self.columns) if self.columns is not None else None}
+            manifest["rids"] = save_strings("rids", self._rids)
+            manifest["coded"] = {col: save_array("coded_{0}.npy".format(i), codes) for i, (col, codes) in enumerate(self.coded.items())}
+            manifest["texts"] = {col: save_strings("text_{0}".format(i), texts) for i, (col, texts) in enumerate(self.texts.items())}
+            manifest["masks"] = {qcol: {"name": save_array("mask_{0}.npy".format(i), self.masks[qcol]), "columns": cols}
+                for i, (qcol, cols) in enumerate(self.ma_cols.items())}
+            with open(os.path.join(tmp, "survey.json"), "w") as f:
+                json.dump(self.survey, f)
+            with open(os.path.join(tmp, "manifest.json"), "w") as f:
+                json.dump(manifest, f)
+            if os.path.exists(path):
+                old = tempfile.mkdtemp(dir=parent, prefix=".snapshot_old_")
+                os.replace(path, os.path.join(old, "snapshot"))
+                os.replace(tmp, path)
+                shutil.rmtree(old)
+            else:
+                os.replace(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        # Opens a snapshot written by save()
+        # With mmap the arrays are memory-mapped read-only: opening takes milliseconds whatever the size, pages are
+        # read only when used, and text columns and response IDs are decoded on first use
+        try:
+            with open(os.path.join(path, "manifest.json")) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            raise RuntimeError("{0} is not a response snapshot\n".format(path))
+        if manifest.get("format") != SNAPSHOT_FORMAT:
+            raise RuntimeError("{0} has snapshot format {1}, expected {2}\n".format(path, manifest.get("format"), SNAPSHOT_FORMAT))
+        with open(os.path.join(path, "survey.json")) as f:
+            survey = json.load(f)
+        def load_array(name):
+            return np.load(os.path.join(path, name), mmap_mode="r" if mmap else None)
+        def load_strings(entry):
+            return StringTable(load_array(entry["name"] + ".data.npy"), load_array(entry["name"] + ".offsets.npy"), entry["json"])
+        store = cls.__new__(cls)
+        store.survey = survey
+        store.schema = SurveySchema(survey)
+        store.columns = set(manifest["columns"]) if manifest["columns"] is not None else None
+        store.ma_cols = {qcol: entry["columns"] for qcol, entry in manifest["masks"].items()}
+        store._assign(load_strings(manifest["rids"]),
+            {col: load_array(name) for col, name in manifest["coded"].items()},
+            {col: load_strings(entry) for col, entry in manifest["texts"].items()},
+            {qcol: load_array(entry["name"]) for qcol, entry in manifest["masks"].items()})
+        return store
+
+    def aggregate(self, key, compute):
+        # Cached additive aggregate: compute(rows) is applied to a row slice and partial results are summed, so after
+        # an append only the new rows are visited
+        epoch, n, value = self.aggregates.get(key, (self.epoch, 0, None))
+        if epoch != self.epoch:
+            n, value = 0, None
+        if value is None or n < self.N:
+            part = compute(slice(n, self.N))
+            if value is not None:
+                size = max(len(value), len(part))
+                value = np.pad(value, (0, size - len(value))) + np.pad(part, (0, size - len(part)))
+            else:
+                value = part
+            self.aggregates[key] = (self.epoch, self.N, value)
+        return value
+    # The counts take where= (see Qv3_filter) to count only a segment of the responses; segments aren't cached
+    def counts(self, col, where=None):
+        # Number of respondents per answer code, unanswered questions excluded
+        codes = self.codes(col)
+        rows = selection(self, where)
+        if rows is not None:
+            codes = codes[rows]
+            return np.bincount(codes[codes >= 0].astype(np.intp))
+        return self.aggregate(("counts", col), lambda rows: np.bincount(codes[rows][codes[rows] >= 0].astype(np.intp)))
+    def bitcounts(self, qcol, where=None):
+        # Number of respondents who selected each choice of an MA question, in ma_columns order
+        k = len(self.ma_columns(qcol))
+        rows = selection(self, where)
+        if rows is not None:
+            return bit_counts(self.masks[qcol][rows], k)
+        return self.aggregate(("bitcounts", qcol), lambda rows: bit_counts(self.masks[qcol][rows], k))
+    def coselection(self, qcol, where=None):
+        # choices x choices matrix of the number of respondents who selected both choices, in ma_columns order
+        k = len(self.ma_columns(qcol))
+        rows = selection(self, where)
+        if rows is not None:
+            return coselection(self.masks[qcol][rows], k)
+        return self.aggregate(("coselection", qcol), lambda rows: coselection(self.masks[qcol][rows], k))
+    def popcounts(self, qcol, where=None):
+        # Number of choices every (selected) respondent selected
+        rows = selection(self, where)
+        return popcount(self.mask(qcol) if rows is None else self.mask(qcol)[rows])
+
+    def _encode(self, values):
+        # Integer codes of a choice column, or None when a value isn't an integer (or a string of one) or too large
+        try:
+            ints = [MISSING if v == "" or v is None else self._code(v) for v in values]
+        except (TypeError, ValueError):
+            return None
+        if ints and (min(ints) < np.iinfo(np.int32).min or max(ints) > np.iinfo(np.int32).max):
+            return None
+        if ints and (min(ints) < MISSING or max(ints) > np.iinfo(np.int8).max):
+            return np.array(ints, dtype=np.int32)
+        return np.array(ints, dtype=np.int8)
+    def _code(self, v):
+        if isinstance(v, bool) or not isinstance(v, (int, str)): # a JSON float is not a choice code
+            raise ValueError(v)
+        return int(v)
+
+    def has(self, col):
+        return col in self.coded or col in self.texts or col in self.masks
+    def answered(self, col): # bool array of respondents who answered col (any choice of an MA question)
+        if col in self.masks:
+            return self.masks[col] != 0
+        if col in self.coded:
+            return self.coded[col] != MISSING
+        if col in self.texts:
+            return self.text(col) != ""
+        raise RuntimeError("{0} is not in the responses\n".format(col))
+
+    def codes(self, col):
+        try:
+            return self.coded[col]
+        except KeyError:
+            raise RuntimeError("{0} is not a choice-coded column\n".format(col))
+    def values(self, col): # float copy of the codes with NaN for unanswered questions
+        codes = self.codes(col)
+        vals = codes.astype(np.float64)
+        vals[codes == MISSING] = np.nan
+        return vals
+    def text(self, col):
+        if col in self.texts:
+            if isinstance(self.texts[col], StringTable):
+                self.texts[col] = self.texts[col].decode()
+            return self.texts[col]
+        codes = self.codes(col)
+        return np.array(["" if c == MISSING else str(c) for c in codes], dtype=object)
+
+    def ma_columns(self, qcol):
+        try:
+            return self.ma_cols[qcol]
+        except KeyError:
+            raise RuntimeError("{0} is not a multiple choice-multiple answer question\n".format(qcol))
+    def mask(self, qcol):
+        self.ma_columns(qcol)
+        return self.masks[qcol]
+    def choice_bits(self, qcol, choices):
+        # Bitmask of MA choices given as sub-columns ("Q2.5_3") or choice keys ("3")
+        cols = self.ma_columns(qcol)
+        keys = self.schema.question(qcol).keys # in the same order as cols
+        bits = 0
+        for c in choices:
+            if c in cols:
+                bits |= 1 << cols.index(c)
+            elif str(c) in keys:
+                bits |= 1 << keys.index(str(c))
+            else:
+                raise RuntimeError("{0} is not a choice of {1}\n".format(c, qcol))
+        return bits
+    def any_selected(self, qcol, choices): # bool array of respondents who picked at least one of the choices
+        return any_set(self.mask(qcol), self.choice_bits(qcol, choices))
+    def all_selected(self, qcol, choices): # ... who picked every one of the choices
+        return all_set(self.mask(qcol), self.choice_bits(qcol, choices))
+    def only_selected(self, qcol, choices): # ... who picked nothing but (some of) the choices
+        return subset_of(self.mask(qcol), self.choice_bits(qcol, choices))
+    def selected(self, col): # bool array of respondents who picked one MA sub-column
+        qcol = col.rsplit("_", 1)[0]
+        bit = self.ma_columns(qcol).index(col)
+        return (self.masks[qcol] >> np.uint64(bit)) & np.uint64(1) == 1
+
+    def isin(self, col, values):
+        if col in self.coded:
+            try:
+                return np.isin(self.coded[col], [int(v) for v in values])
+            except (TypeError, ValueError):
+                pass
+        return np.isin(self.text(col), [str(v) for v in values])
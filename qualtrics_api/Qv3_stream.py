@@ -0,0 +1,70 @@
+import codecs
+import json
+
+def iter_responses(fp, chunk_size=1 << 16):
+    # Yields the entries of the "responses" array of a Qualtrics JSON export one at a time
+    # fp may be a text or binary file object; only one chunk plus the response being decoded is held in memory
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    state = {"buf": "", "eof": False}
+    def more():
+        chunk = fp.read(chunk_size)
+        if not chunk: # test the raw read: a chunk ending inside a multi-byte character decodes to ""
+            state["eof"] = True
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk, final=not chunk)
+        state["buf"] += chunk
+    def skip(pos, chars):
+        while True:
+            buf = state["buf"]
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf) or state["eof"]:
+                return pos
+            more()
+    # find the start of the responses array
+    pos = 0
+    while True:
+        start = state["buf"].find('"responses"', pos)
+        if start >= 0:
+            pos = skip(start + len('"responses"'), " \t\r\n:")
+            if pos < len(state["buf"]) and state["buf"][pos] == "[":
+                pos += 1
+                break
+            pos = start + 1
+            continue
+        if state["eof"]:
+            raise ValueError("No responses array found in the export")
+        pos = max(0, len(state["buf"]) - len('"responses"'))
+        more()
+    while True:
+        pos = skip(pos, " \t\r\n,")
+        buf = state["buf"]
+        if pos >= len(buf):
+            raise ValueError("Unexpected end of export inside the responses array")
+        if buf[pos] == "]":
+            return
+        try:
+            resp, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if state["eof"]:
+                raise
+            more() # the response is cut off at the end of the buffer
+            continue
+        yield resp
+        pos = end
+        if pos > chunk_size: # drop what has been consumed once it outgrows a chunk
+            state["buf"] = buf[pos:]
+            pos = 0
+
+def write_responses(fp, responses):
+    # Writes response dicts to the binary file object fp as a Qualtrics JSON export; returns the number written
+    n = 0
+    fp.write(b'{"responses": [')
+    for resp in responses:
+        if n:
+            fp.write(b", ")
+        fp.write(json.dumps(resp).encode("UTF-8"))
+        n += 1
+    fp.write(b"]}")
+    return n
@@ -0,0 +1,197 @@
+import atexit
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+
+from qualtrics_api.QualtricsException import QualtricsException
+
+_live = set() # workspaces whose directories are still on disk
+_live_lock = threading.Lock()
+
+@atexit.register
+def _remove_all():
+    for ws in list(_live):
+        ws.remove_all()
+
+class Workspace:
+    # Private temporary directory for one session's downloaded and extracted exports
+    # Every workspace gets its own mkdtemp directory, so concurrent sessions and exports never share file names.
+    # Users of its files hold a reference (acquire/release or `with workspace.use()`); close() removes the directory
+    # once the last reference is released, and whatever is left is removed when the interpreter exits.  Until then a
+    # workspace stays on disk even after the session that made it is gone, so the paths it returned remain valid.
+    # Writes through open() and spool(), and extractions, count against `quota` bytes (None for no limit)
+    def __init__(self, root=None, quota=None, prefix="qualtrics_"):
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=root)
+        self.quota = quota
+        self.used = 0
+        self.refs = 0
+        self.closing = False
+        self.lock = threading.Lock()
+        with _live_lock:
+            _live.add(self)
+
+    def acquire(self):
+        with self.lock:
+            if self.closing and self.refs == 0:
+                raise QualtricsException("Workspace {0} has been closed".format(self.path))
+            self.refs += 1
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            remove = self.closing and self.refs == 0
+        if remove:
+            self.remove_all()
+    def use(self):
+        return WorkspaceRef(self)
+    def close(self):
+        # Removes the workspace now, or as soon as its files are no longer in use
+        with self.lock:
+            self.closing = True
+            remove = self.refs == 0
+        if remove:
+            self.remove_all()
+    def remove_all(self):
+        # Deletes the directory right away, whether or not its files are in use; runs once
+        with _live_lock:
+            if self not in _live:
+                return
+            _live.discard(self)
+        shutil.rmtree(self.path, ignore_errors=True)
+    @property
+    def closed(self):
+        return self not in _live
+
+    def reserve(self, nbytes):
+        # Accounts for nbytes more on disk; raises QualtricsException when that would exceed the quota
+        with self.lock:
+            if self.quota is not None and self.used + nbytes > self.quota:
+                raise QualtricsException("Workspace quota of {0} bytes exceeded ({1} in use, {2} more requested)".format(
+                    self.quota, self.used, nbytes))
+            self.used += nbytes
+    def unreserve(self, nbytes):
+        with self.lock:
+            self.used = max(self.used - nbytes, 0)
+
+    def mkdtemp(self, prefix=None):
+        return tempfile.mkdtemp(prefix=prefix, dir=self.path)
+    def open(self, path, mode="w+b"):
+        # Binary file in the workspace whose writes count against the quota
+        return QuotaFile(self, path, mode.replace("b", ""))
+    def spool(self, max_size):
+        # Spooled temporary file that rolls over to an unnamed file in the workspace past max_size bytes; all of it
+        # counts against the quota, in memory or not, until it is closed
+        return QuotaSpool(self, max_size)
+    def remove(self, path):
+        # Deletes a file or directory from the workspace and gives its space back to the quota
+        if os.path.isdir(path):
+            size = sum(os.path.getsize(os.path.join(d, f)) for d, dirs, files in os.walk(path) for f in files)
+            shutil.rmtree(path)
+        else:
+            size = os.path.getsize(path)
+            os.remove(path)
+        self.unreserve(size)
+    def extract(self, zip_path, dest):
+        # Extracts a zip into dest after reserving its uncompressed size; returns the path of the first member
+        with zipfile.ZipFile(zip_path) as z:
+            members = z.infolist()
+            self.reserve(sum(m.file_size for m in members))
+            z.extractall(dest)
+        return os.path.join(dest, members[0].filename)
+    def map(self, path):
+        # Read-only memory-mapped stream over a file in the workspace; holds a reference until closed
+        return MappedFile(self, path)
+
+class WorkspaceRef:
+    def __init__(self, workspace):
+        self.workspace = workspace
+    def __enter__(self):
+        self.workspace.acquire()
+        return self.workspace
+    def __exit__(self, *exc):
+        self.workspace.release()
+
+class QuotaFile(io.FileIO):
+    def __init__(self, workspace, path, mode):
+        super().__init__(path, mode)
+        self.workspace = workspace
+    def write(self, b):
+        end = self.tell() + len(b)
+        size = os.fstat(self.fileno()).st_size
+        self.workspace.reserve(max(end - size, 0))
+        return super().write(b)
+    def truncate(self, size=None):
+        old = os.fstat(self.fileno()).st_size
+        new = super().truncate(size)
+        self.workspace.unreserve(max(old - new, 0))
+        return new
+
+class QuotaSpool(tempfile.SpooledTemporaryFile):
+    def __init__(self, workspace, max_size):
+        super().__init__(max_size=max_size, prefix="spool_", dir=workspace.path)
+        self.workspace = workspace
+        self.size = 0
+    def write(self, b):
+        end = self.tell() + len(b)
+        if end > self.size:
+            self.workspace.reserve(end - self.size)
+            self.size = end
+        return super().write(b)
+    def truncate(self, size=None):
+        new = self.tell() if size is None else size
+        result = super().truncate(size)
+        if new < self.size:
+            self.workspace.unreserve(self.size - new)
+            self.size = new
+        return result
+    def close(self):
+        if not self.closed:
+            self.workspace.unreserve(self.size)
+            self.size = 0
+        super().close()
+
+class MappedFile(io.RawIOBase):
+    # The file's pages come straight from the page cache; nothing is copied into Python buffers until read
+    def __init__(self, workspace, path):
+        workspace.acquire()
+        self.workspace = workspace
+        self.name = path
+        self.map = None
+        try:
+            if os.path.getsize(path) > 0: # empty files can't be mapped
+                with open(path, "rb") as f:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            workspace.release()
+            raise
+    def readable(self):
+        return True
+    def seekable(self):
+        return True
+    def seek(self, offset, whence=io.SEEK_SET):
+        # rewinding re-reads the mapped pages instead of extracting the export again
+        if self.map is None:
+            return 0
+        self.map.seek(offset, whence)
+        return self.map.tell()
+    def tell(self):
+        return self.map.tell() if self.map is not None else 0
+    def readinto(self, b):
+        if self.map is None:
+            return 0
+        data = self.map.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+    def read(self, size=-1):
+        if self.map is None:
+            return b""
+        return self.map.read(size if size is not None and size >= 0 else None)
+    def close(self):
+        if not self.closed:
+            if self.map is not None:
+                self.map.close()
+            self.workspace.release()
+        super().close()
@@ -0,0 +1,67 @@
+import concurrent.futures
+import multiprocessing
+import os
+
+# Rendering of prepared graphs, split from the data preparation in run_graphs so that figures can be drawn either
+# interactively or in batch on a process pool.  A Graph carries only plain pandas data and keyword arguments, so it
+# pickles cheaply to the workers, and the workers never touch the interactive session's pyplot state.
+
+class Graph:
+    def __init__(self, name, plot, data, size=None, **kwargs):
+        self.name = name # also the output file name
+        self.plot = plot # module-level function (data, ax=..., **kwargs), e.g. pdplot.pdplot
+        self.data = data
+        self.size = size # figure size in inches, or None for the default
+        self.kwargs = kwargs
+
+    def draw(self, ax):
+        return self.plot(self.data, ax=ax, **self.kwargs)
+
+def show(graph):
+    # Draws the graph in a new figure of the current (interactive) pyplot backend
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots()
+    if graph.size:
+        fig.set_size_inches(*graph.size, forward=True)
+    graph.draw(ax)
+    return fig
+
+def save(graph, outdir, formats=("png",), dpi=None, style=None):
+    # Draws the graph on an Agg canvas without pyplot and writes one file per format; returns the paths written
+    import matplotlib.style
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    with matplotlib.style.context(style or []):
+        fig = Figure(figsize=graph.size, layout="tight")
+        FigureCanvasAgg(fig)
+        graph.draw(fig.add_subplot())
+        paths = []
+        for fmt in formats:
+            path = os.path.join(outdir, "{0}.{1}".format(graph.name, fmt))
+            fig.savefig(path, format=fmt, dpi=dpi)
+            paths.append(path)
+    return paths
+
+def use_agg():
+    # Pool initializer: workers started without a parent's state must not pick an interactive backend
+    import matplotlib
+    matplotlib.use("Agg")
+
+def save_all(graphs, outdir, formats=("png",), workers=None, dpi=None, style=None):
+    # Renders independent graphs in parallel and writes them to outdir; returns {name: [paths]}
+    # workers=1 renders in this process, which is also the fallback when there is only one graph
+    os.makedirs(outdir, exist_ok=True)
+    graphs = list(graphs)
+    if workers is None:
+        workers = min(len(graphs), os.cpu_count() or 1)
+    if workers <= 1 or len(graphs) <= 1:
+        return {g.name: save(g, outdir, formats, dpi, style) for g in graphs}
+    # fork shares the already-imported modules with the workers; spawning would re-run the caller's script
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+    paths = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=use_agg) as pool:
+        futures = {pool.submit(save, g, outdir, formats, dpi, style): g.name for g in graphs}
+        for f in concurrent.futures.as_completed(futures):
+            paths[futures[f]] = f.result()
+    return {g.name: paths[g.name] for g in graphs}
@@ -1,148 +1,210 @@
-# this script is designed to be run via the IPython %run magic
-import matplotlib.pyplot as plt
+# Graphs of the survey results, drawn interactively from IPython or rendered to files by the report command
 import numpy as np
+import os
+import pandas as pd
 import sys
 
+from qualtrics_api.Qv3_filter import selection
 import pdplot as p
-import qualtrics_api.Qv3_helpers as qh
+import render as r
 import settings
 import util as u
 
-try:
-    __IPYTHON__
-    pass
-except NameError:
-    raise RuntimeError("This script is for IPython magics")
-
-def run_graphs(graph=None, qh=None, nars=None, nars_calc=None, nars_mrp_calc=None, **kwargs):
-    #demographics
-    if graph is None or graph=="age":
-        print("Plotting age demographics")
-        f1,a1 = plt.subplots()
-        p.pdplot(qh.mc2list("Q2.1"), title="Age", ax=a1)
-    if graph is None or graph=="cu":
-        print("Plotting computer usage")
-        f2,a2 = plt.subplots()
-        d = qh.pairs2list(qh.mcpaired("Q2.2", "Q2.1"))
-        p.pdplot(d, title="Computer Use", stacked=True, ax=a2)
-    if graph is None or graph=="cul":
-        print("Plotting computer usage location")
-        f3,a3 = plt.subplots()
-        p.pdplot(qh.ma2list("Q2.3"), title="Computer Use Location", label_clip=30, ax=a3)
-    if graph is None or graph=="cn":
-        print("Plotting computer knowledge")
-        f4,a4 = plt.subplots()
-        d = qh.pairs2list(qh.mcpaired("Q2.4", "Q2.1"))
-        p.pdplot(d, title="Computer Knowledge", xtick_labels=settings.cQ2_4_short, stacked=True, ax=a4)
-    if graph is None or graph=="ge":
-        print("Plotting games enjoyed")
-        f5,a5 = plt.subplots()
-        p.pdplot(qh.ma2list("Q2.5"), title="Games Enjoyed", xtick_labels=settings.cQ2_5_short, ax=a5)
-    if graph is None or graph=="itss":
-        print("Plotting IT support sources")
-        f6,a6 = plt.subplots()
-        p.pdplot(qh.ma2list("Q3.1"), title="Sources of IT support", xtick_labels=settings.cQ3_1_short, ax=a6)
-    if graph is None or graph=="itse":
-        print("Plotting tech support experience")
-        d = qh.list_grouper(qh.mc2list("Q3.5", percent=False), qh.mc2list("Q3.8", percent=False), qh.mc2list("Q3.11", percent=False), 
-            qh.mc2list("Q3.14", percent=False), qh.mc2list("Q3.17", percent=False), qh.mc2list("Q3.20", percent=False), 
-            qh.mc2list("Q3.23", percent=False), qh.mc2list("Q3.26", percent=False))
-        d = d.drop("Not applicable",0)
-        f7,a7 = plt.subplots()
-        f7.set_size_inches(10, 6, forward=True)
-        legend = ("In Person", "Phone", "Email", "SMS", "Live Chat", "Forums", "Remote Access", "Other")
-        p.pdplot(d, legend=legend, title="Tech Support Experiences", ax=a7)
-    if graph is None or graph=="itsen":
-        print("Plotting tech support experience (normalized)")
-        d = qh.list_grouper(qh.mc2list("Q3.5", percent=True), qh.mc2list("Q3.8", percent=True), qh.mc2list("Q3.11", percent=True), 
-            qh.mc2list("Q3.14", percent=True), qh.mc2list("Q3.17", percent=True), qh.mc2list("Q3.20", percent=True), 
-            qh.mc2list("Q3.23", percent=True), qh.mc2list("Q3.26", percent=True))
-        d = d.drop("Not applicable",0)
-        f8,a8 = plt.subplots()
-        f8.set_size_inches(10, 6, forward=True)
-        legend = ("In Person", "Phone", "Email", "SMS", "Live Chat", "Forums", "Remote Access", "Other", "Total")
-        p.pdplot(d, legend=legend, title="Tech Support Experiences (normalized)", ax=a8)
-    if graph is None or graph=="mrpe":
-        print("Plotting MRP exp")
-        d = qh.mcmatrix("Q4.2")
-        f9,a9 = plt.subplots()
-        p.pdplot(d, title="MRP Experience", ax=a9, stacked=True)
-
-    #nars
-    if graph is None or graph=="nars_avg":
-        print("Plotting NARS averages")
-        f10,a10 = plt.subplots()
-        n = nars.means(*nars_calc())
-        p.pdplot(n.loc['mean'], title="MRP NARS Scores", yerr=n.loc['std'], ybound=[1,5], ax=a10)
-    if graph is None or graph=="itnars_avg":
-        print("Plotting IT MRP NARS averages")
-        f11,a11 = plt.subplots()
-        n = nars.means(*nars_mrp_calc())
-        p.pdplot(n.loc['mean'], title="IT MRP NARS Scores", yerr=n.loc['std'], ybound=[1,5], ax=a11)
-    
-    if graph is None or graph == "nars_age":
-        print("Plotting NARS split by age")
-        f12,a12 = plt.subplots()
-        f12.set_size_inches(9.75, 6, forward=True)
-        p.nars_graphby_mc(nars, *nars_calc(), "Q2.1", title="MRP NARS by Age Group", ybound=[1,5], ax=a12)
-    if graph is None or graph == "itnars_age":
-        print("Plotting IT MRP NARS split by age")
-        f13,a13 = plt.subplots()
-        f13.set_size_inches(9.75, 6, forward=True)
-        p.nars_graphby_mc(nars, *nars_mrp_calc(), "Q2.1", title="IT MRP NARS by Age Group", ybound=[1,5], ax=a13)
-    
-    if graph is None or graph == "nars_skill":
-        print("Plotting NARS split by computer skil")
-        f14,a14 = plt.subplots()
-        f14.set_size_inches(9.75, 6, forward=True)
-        legend=("Basic", "Knowledgable", "Enthusiast", "Professional", "Other")
-        p.nars_graphby_mc(nars, *nars_calc(), "Q2.4", title="MRP NARS by Computer Skill", legend=legend, ybound=[1,5], ax=a14)
-    if graph is None or graph == "itnars_skill":
-        print("Plotting IT MRP NARS split by computer skill")
-        f15,a15 = plt.subplots()
-        f15.set_size_inches(9.75, 6, forward=True)
-        legend=("Basic", "Knowledgable", "Enthusiast", "Professional", "Other")
-        p.nars_graphby_mc(nars, *nars_mrp_calc(), "Q2.4", title="IT MRP NARS by Computer Skill", legend= legend, ybound=[1,5], ax=a15)
-
-    if graph is None or graph == "nars_game":
-        print("Plotting NARS split by gaming experience")
-        f16,a16 = plt.subplots()
-        f16.set_size_inches(12, 9, forward=True)
-        legend=("Not Applicable", "MMO", "MOBA", "RPG", "RTS", "FPS", "Sandbox / Open World", "Action / Adventure", "Interactive Fiction", "Casual", "Other")
-        p.nars_graphby_ma(nars, *nars_calc(), "Q2.5", title="MRP NARS by Gaming Experience", legend=legend, ybound=[1,5], ax=a16)
-    if graph is None or graph == "itnars_game":
-        print("Plotting IT MRP NARS split gaming experience")
-        f17,a17 = plt.subplots()
-        f17.set_size_inches(12, 9, forward=True)
-        legend=("Not Applicable", "MMO", "MOBA", "RPG", "RTS", "FPS", "Sandbox / Open World", "Action / Adventure", "Interactive Fiction", "Casual", "Other")
-        p.nars_graphby_ma(nars, *nars_mrp_calc(), "Q2.5", title="IT MRP NARS by Gaming Experience", legend= legend, ybound=[1,5], ax=a17)
-
-    if graph is None or graph == "nars_mrpe":
-        print("Plotting NARS split by MRP Experience")
-        f18,a18 = plt.subplots()
-        hq = qh.hasqs_in_val(["Q4.2_1", "Q4.2_2", "Q4.2_3", "Q4.2_4"], ["2", "3", "4", "5"])
-        na = nars.associate_byinfo(*nars_calc(), hq)
-        p.nars_graphby_info(nars, na, {True:"Has MRP experience", False:"No MRP Experience"}, title="MRP NARS by MRP Experience", ybound=[1,5], ax=a18)
-    if graph is None or graph == "itnars_mrpe":
-        print("Plotting IT NARS split by MRP Experience")
-        f19,a19 = plt.subplots()
-        hq = qh.hasqs_in_val(["Q4.2_1", "Q4.2_2", "Q4.2_3", "Q4.2_4"], ["2", "3", "4", "5"])
-        na = nars.associate_byinfo(*nars_mrp_calc(), hq)
-        p.nars_graphby_info(nars, na, {True:"Has MRP experience", False:"No MRP Experience"}, title="IT MRP NARS by MRP Experience", ybound=[1,5], ax=a19)
-
-    if graph is None or graph == "itswa":
-        lg = qh.list_grouper(qh.mc2list("Q3.5"), qh.mc2list("Q3.8"), qh.mc2list("Q3.11"), qh.mc2list("Q3.14"), qh.mc2list("Q3.17"), qh.mc2list("Q3.20"), 
-            qh.mc2list("Q3.23"), qh.mc2list("Q3.26"))
-        columns = ("In Person", "Phone", "Email", "SMS", "Live Chat", "Forums", "Remote Access", "Other")
-        lg.columns = columns
-        lgna = lg.drop("Not applicable",0)
+# Declarative registry of the graphs (and tables).  Each one declares the aggregates it reads as keys
+# (kind, *args), e.g. ("mc", "Q2.1") or ("nars_mc", "mrp", "Q2.1"); run_graphs plans the union of the keys of the
+# selected graphs, computes every aggregate once and shares it between the graphs that need it.
+
+AGGREGATES = {} # kind -> (function(plan, *args), positions of the args that are question columns)
+GRAPHS = {} # name -> GraphSpec, in report order
+
+def aggregate(kind, questions=()):
+    def register(fn):
+        AGGREGATES[kind] = (fn, questions)
+        return fn
+    return register
+
+class GraphSpec:
+    def __init__(self, name, message, inputs, plot=p.pdplot, prepare=None, size=None, **options):
+        self.name = name
+        self.message = message
+        self.inputs = [tuple(k) for k in inputs]
+        self.plot = plot # None for tables, which are printed instead of plotted
+        self.prepare = prepare # function(*aggregates) -> plot data; default: the only input as is
+        self.size = size
+        self.options = options
+
+def graph(name, message, inputs, **kwargs):
+    GRAPHS[name] = GraphSpec(name, message, inputs, **kwargs)
+
+class Plan:
+    # Memoized aggregates for one run; aggregates may depend on other aggregates through get()
+    # where restricts every aggregate to a segment of the respondents (see Qv3_filter); it is evaluated once per run
+    def __init__(self, qh, nars, nars_calc, nars_mrp_calc, where=None):
+        self.qh = qh
+        self.nars = nars
+        self.scores = {"mrp":nars_calc, "itmrp":nars_mrp_calc}
+        self.where = None if where is None else selection(qh.store, where)
+        self.data = {}
+    def get(self, key):
+        if key not in self.data:
+            fn, questions = AGGREGATES[key[0]]
+            self.data[key] = fn(self, *key[1:])
+        return self.data[key]
+    def compute(self, specs):
+        keys = dict.fromkeys(k for s in specs for k in s.inputs) # union of the inputs, in first-use order
+        for k in keys:
+            self.get(k)
+        return keys
+
+def questions(specs):
+    # Question columns read by the given graphs; a question ID covers all of its sub-columns
+    columns = {}
+    for s in specs:
+        for key in s.inputs:
+            for i in AGGREGATES[key[0]][1]:
+                qs = key[1 + i]
+                columns.update(dict.fromkeys(qs if isinstance(qs, tuple) else (qs,)))
+    return list(columns)
+
+@aggregate("mc", questions=[0])
+def _mc(plan, qcol):
+    return plan.qh.mc2list(qcol, where=plan.where)
+@aggregate("mc_percent", questions=[0])
+def _mc_percent(plan, qcol):
+    return plan.qh.mc2list(qcol, percent=True, where=plan.where)
+@aggregate("ma", questions=[0])
+def _ma(plan, qcol):
+    return plan.qh.ma2list(qcol, where=plan.where)
+@aggregate("pairs", questions=[0, 1])
+def _pairs(plan, qcol1, qcol2):
+    return plan.qh.pairs2list(plan.qh.mcpaired(qcol1, qcol2, where=plan.where))
+@aggregate("matrix", questions=[0])
+def _matrix(plan, qcol):
+    return plan.qh.mcmatrix(qcol, where=plan.where)
+@aggregate("hasqs", questions=[0])
+def _hasqs(plan, qcols, values):
+    return plan.qh.hasqs_in_val(list(qcols), list(values), where=plan.where)
+@aggregate("scores")
+def _scores(plan, which):
+    # The three subscale scores of the "mrp" or "itmrp" NARS
+    return plan.scores[which]()
+@aggregate("nars_means")
+def _nars_means(plan, which):
+    return plan.nars.means(*plan.get(("scores", which)), where=plan.where)
+@aggregate("nars_mc", questions=[1])
+def _nars_mc(plan, which, qcol):
+    return plan.nars.associate_mc_mean(plan.nars.associate_mc(*plan.get(("scores", which)), [qcol], where=plan.where), qcol)
+@aggregate("nars_ma", questions=[1])
+def _nars_ma(plan, which, qcol):
+    return plan.nars.associate_ma_mean(plan.nars.associate_ma(*plan.get(("scores", which)), [qcol], where=plan.where), qcol)
+@aggregate("nars_mrpe")
+def _nars_mrpe(plan, which, hasqs):
+    na = plan.nars.associate_byinfo(*plan.get(("scores", which)), plan.get(hasqs), where=plan.where)
+    return plan.nars.associate_byinfo_mean(na, {True:"Has MRP experience", False:"No MRP Experience"})
+
+SUPPORT = ["Q3.5", "Q3.8", "Q3.11", "Q3.14", "Q3.17", "Q3.20", "Q3.23", "Q3.26"]
+SUPPORT_NAMES = ("In Person", "Phone", "Email", "SMS", "Live Chat", "Forums", "Remote Access", "Other")
+MRP_EXPERIENCE = ("hasqs", ("Q4.2_1", "Q4.2_2", "Q4.2_3", "Q4.2_4"), ("2", "3", "4", "5"))
+SKILL_LEGEND = ("Basic", "Knowledgable", "Enthusiast", "Professional", "Other")
+GAME_LEGEND = ("Not Applicable", "MMO", "MOBA", "RPG", "RTS", "FPS", "Sandbox / Open World", "Action / Adventure", "Interactive Fiction", "Casual", "Other")
+
+def _support_experience(*lists):
+    d = pd.DataFrame([*lists]).transpose()
+    return d.drop("Not applicable", axis=0)
+def _support_likert(*lists):
+    lg = _support_experience(*lists)
+    lg.columns = SUPPORT_NAMES
+    rows = {}
+    for i in lg.columns:
         try:
-            dec = kwargs['places']
-        except KeyError:
-            dec = 4
-        for i in lgna.columns:
-            try:
-                sys.stdout.write("{0} {2:.{1}f} {3:.{1}f}\n".format(i, dec, *u.likert_ms(lgna[i])))
-            except ZeroDivisionError:
-                sys.stdout.write("{0} {2:.{1}f} {3:.{1}f}\n".format(i, dec, np.NaN, np.NaN))
+            rows[i] = u.likert_ms(lg[i])
+        except ZeroDivisionError:
+            rows[i] = (np.nan, np.nan)
+    return rows
+
+#demographics
+graph("age", "Plotting age demographics", [("mc", "Q2.1")], title="Age")
+graph("cu", "Plotting computer usage", [("pairs", "Q2.2", "Q2.1")], title="Computer Use", stacked=True)
+graph("cul", "Plotting computer usage location", [("ma", "Q2.3")], title="Computer Use Location", label_clip=30)
+graph("cn", "Plotting computer knowledge", [("pairs", "Q2.4", "Q2.1")], title="Computer Knowledge", xtick_labels=settings.cQ2_4_short, stacked=True)
+graph("ge", "Plotting games enjoyed", [("ma", "Q2.5")], title="Games Enjoyed", xtick_labels=settings.cQ2_5_short)
+graph("itss", "Plotting IT support sources", [("ma", "Q3.1")], title="Sources of IT support", xtick_labels=settings.cQ3_1_short)
+graph("itse", "Plotting tech support experience", [("mc", q) for q in SUPPORT], prepare=_support_experience, size=(10, 6),
+    legend=SUPPORT_NAMES, title="Tech Support Experiences")
+graph("itsen", "Plotting tech support experience (normalized)", [("mc_percent", q) for q in SUPPORT], prepare=_support_experience, size=(10, 6),
+    legend=SUPPORT_NAMES + ("Total",), title="Tech Support Experiences (normalized)")
+graph("mrpe", "Plotting MRP exp", [("matrix", "Q4.2")], title="MRP Experience", stacked=True)
+
+#nars
+graph("nars_avg", "Plotting NARS averages", [("nars_means", "mrp")], plot=p.means_plot, title="MRP NARS Scores", ybound=[1,5])
+graph("itnars_avg", "Plotting IT MRP NARS averages", [("nars_means", "itmrp")], plot=p.means_plot, title="IT MRP NARS Scores", ybound=[1,5])
+graph("nars_age", "Plotting NARS split by age", [("nars_mc", "mrp", "Q2.1")], plot=p.nars_plot, size=(9.75, 6),
+    title="MRP NARS by Age Group", ybound=[1,5])
+graph("itnars_age", "Plotting IT MRP NARS split by age", [("nars_mc", "itmrp", "Q2.1")], plot=p.nars_plot, size=(9.75, 6),
+    title="IT MRP NARS by Age Group", ybound=[1,5])
+graph("nars_skill", "Plotting NARS split by computer skil", [("nars_mc", "mrp", "Q2.4")], plot=p.nars_plot, size=(9.75, 6),
+    title="MRP NARS by Computer Skill", legend=SKILL_LEGEND, ybound=[1,5])
+graph("itnars_skill", "Plotting IT MRP NARS split by computer skill", [("nars_mc", "itmrp", "Q2.4")], plot=p.nars_plot, size=(9.75, 6),
+    title="IT MRP NARS by Computer Skill", legend=SKILL_LEGEND, ybound=[1,5])
+graph("nars_game", "Plotting NARS split by gaming experience", [("nars_ma", "mrp", "Q2.5")], plot=p.nars_plot, size=(12, 9),
+    title="MRP NARS by Gaming Experience", legend=GAME_LEGEND, ybound=[1,5])
+graph("itnars_game", "Plotting IT MRP NARS split gaming experience", [("nars_ma", "itmrp", "Q2.5")], plot=p.nars_plot, size=(12, 9),
+    title="IT MRP NARS by Gaming Experience", legend=GAME_LEGEND, ybound=[1,5])
+graph("nars_mrpe", "Plotting NARS split by MRP Experience", [("nars_mrpe", "mrp", MRP_EXPERIENCE), MRP_EXPERIENCE], plot=p.nars_plot,
+    title="MRP NARS by MRP Experience", ybound=[1,5])
+graph("itnars_mrpe", "Plotting IT NARS split by MRP Experience", [("nars_mrpe", "itmrp", MRP_EXPERIENCE), MRP_EXPERIENCE], plot=p.nars_plot,
+    title="IT MRP NARS by MRP Experience", ybound=[1,5])
+
+#tables
+graph("itswa", None, [("mc", q) for q in SUPPORT], plot=None, prepare=_support_likert)
+
+# Question columns read by the graphs above, for loading only what the report needs
+COLUMNS = questions(GRAPHS.values())
+
+def select(graph=None):
+    # None selects every graph, otherwise a name or a list of names
+    if graph is None:
+        return list(GRAPHS.values())
+    names = [graph] if isinstance(graph, str) else list(graph)
+    unknown = [g for g in names if g not in GRAPHS]
+    if unknown:
+        raise RuntimeError("Unknown graph(s) {0}; choose from {1}".format(", ".join(unknown), ", ".join(GRAPHS)))
+    return [GRAPHS[g] for g in names]
+
+def write_table(rows, places=4, out=sys.stdout):
+    for name, (mean, std) in rows.items():
+        out.write("{0} {2:.{1}f} {3:.{1}f}\n".format(name, places, mean, std))
+
+def run_graphs(graph=None, qh=None, nars=None, nars_calc=None, nars_mrp_calc=None, outdir=None, formats=("png",), workers=None,
+        where=None, **kwargs):
+    # Computes the aggregates the selected graphs need, prepares each graph's data, then renders it: into interactive
+    # figures, or with outdir set, in batch on a process pool into one file per graph and format (png, svg, pdf, ...)
+    # Tables are printed, or with outdir set, written to <name>.txt.  where restricts every graph to a segment of the
+    # respondents, e.g. where=In("Q2.1", ["1", "2"]) (see Qv3_filter)
+    specs = select(graph)
+    plan = Plan(qh, nars, nars_calc, nars_mrp_calc, where=where)
+    plan.compute(specs)
+    graphs = []
+    tables = {}
+    for s in specs:
+        inputs = [plan.get(k) for k in s.inputs]
+        data = s.prepare(*inputs) if s.prepare else inputs[0]
+        if s.plot is None:
+            if outdir is None:
+                write_table(data, places=kwargs.get('places', 4))
+            else:
+                os.makedirs(outdir, exist_ok=True)
+                tables[s.name] = [os.path.join(outdir, s.name + ".txt")]
+                with open(tables[s.name][0], "w") as f:
+                    write_table(data, places=kwargs.get('places', 4), out=f)
+            continue
+        if s.message:
+            print(s.message)
+        graphs.append(r.Graph(s.name, s.plot, data, size=s.size, **s.options))
 
+    if outdir is None:
+        return {g.name: r.show(g) for g in graphs}
+    print("Rendering {0} graphs to {1}".format(len(graphs), outdir))
+    paths = r.save_all(graphs, outdir, formats=formats, workers=workers)
+    paths.update(tables)
+    return paths
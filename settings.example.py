@@ -1,6 +1,13 @@
 qualtrics_datacenter = "umn.qualtrics.com"
 qualtrics_api_key = "<your key here>"
-qualtrics_survey = "<your survey here>"
+qualtrics_survey = "<your survey here>" # or a list of survey IDs
+combine_surveys = True # with several surveys: analyze all responses together, or one survey at a time (use(sid))
+export_concurrency = 4 # surveys exported and downloaded at the same time
+
+cache_dir = "~/.cache/itmrp"
+cache_ttl = 3600 # seconds before a cached survey definition is checked against Qualtrics again
+cache_max_bytes = 2*1024*1024*1024
+workspace_quota = None # bytes a session's downloads and extracted exports may take up at once, None for no limit
 
 nars_s1 = ["Q5.1_4", "Q5.1_7", "Q5.1_8", "Q5.1_9", "Q5.1_10", "Q5.1_12"]
 nars_s2 = ["Q5.1_1", "Q5.1_2", "Q5.1_11", "Q5.1_13", "Q5.1_14"]
@@ -0,0 +1,104 @@
+import asyncio
+import http.client as HTC
+import http.server
+import threading
+import unittest
+
+from qualtrics_api.Qv3_async import AsyncConnectionPool
+
+# The asyncio client parses HTTP/1.1 itself, so it is run against http.server standing in for Qualtrics
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    def log_message(self, *args):
+        pass
+    def do_GET(self):
+        self.server.requests.append((self.command, self.path))
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        served = getattr(self, "served", 0) # one handler per connection
+        self.served = served + 1
+        if self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(b"5\r\nhello\r\n7;ext=1\r\n, world\r\n0\r\nX-Trailer: 1\r\n\r\n")
+        elif self.path == "/until-close":
+            # no Content-Length: the body runs until the server closes the connection
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b"x" * 100000)
+            self.close_connection = True
+        elif self.path == "/stale" and served > 0:
+            # a keep-alive connection the server has given up on: the request is read but never answered
+            self.close_connection = True
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+    do_POST = do_GET
+
+class AsyncHTTPTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.host = "127.0.0.1:{0}".format(self.server.server_address[1])
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_pool(self, coro):
+        async def main():
+            pool = AsyncConnectionPool(self.host, scheme="http")
+            try:
+                return await coro(pool)
+            finally:
+                pool.close()
+        return asyncio.run(main())
+
+    def test_chunked(self):
+        async def fetch(pool):
+            whole = await (await pool.request("GET", "/chunked")).read()
+            resp = await pool.request("GET", "/chunked")
+            parts = []
+            while True:
+                buf = await resp.read(3)
+                if not buf:
+                    break
+                parts.append(buf)
+            return whole, parts, len(pool.idle)
+        whole, parts, idle = self.run_pool(fetch)
+        self.assertEqual(whole, b"hello, world")
+        self.assertEqual(b"".join(parts), b"hello, world")
+        self.assertTrue(all(len(p) <= 3 for p in parts))
+        self.assertEqual(idle, 1) # trailers consumed, the connection is reused
+
+    def test_read_until_close(self):
+        async def fetch(pool):
+            resp = await pool.request("GET", "/until-close")
+            body = await resp.read()
+            return body, len(pool.idle)
+        body, idle = self.run_pool(fetch)
+        self.assertEqual(body, b"x" * 100000)
+        self.assertEqual(idle, 0)
+
+    def test_stale_keepalive_get_retried(self):
+        async def fetch(pool):
+            first = await (await pool.request("GET", "/stale")).read()
+            second = await (await pool.request("GET", "/stale")).read()
+            return first, second
+        self.assertEqual(self.run_pool(fetch), (b"ok", b"ok"))
+        self.assertEqual(self.server.requests, [("GET", "/stale")] * 3)
+
+    def test_stale_keepalive_post_not_resent(self):
+        async def fetch(pool):
+            await (await pool.request("POST", "/stale", body="{}")).read()
+            await pool.request("POST", "/stale", body="{}")
+        with self.assertRaises(HTC.RemoteDisconnected):
+            self.run_pool(fetch)
+        self.assertEqual(self.server.requests, [("POST", "/stale")] * 2)
+
+if __name__ == "__main__":
+    unittest.main()
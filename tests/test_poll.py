@@ -0,0 +1,128 @@
+import http.server
+import io
+import json
+import threading
+import unittest
+from urllib.parse import urlparse
+import zipfile
+
+from qualtrics_api.QualtricsException import QualtricsException
+from qualtrics_api.Qv3 import Qualtrics_v3
+from qualtrics_api.Qv3_poll import ExportPoller
+
+# ExportPoller runs on an injected clock, sleep and random source, and response_export is run against http.server
+# standing in for the Qualtrics export API
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+    def __call__(self):
+        return self.now
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def poller(clock, **kwargs):
+    kwargs.setdefault("rand", lambda: 0.5) # no jitter
+    return ExportPoller(initial=1.0, maximum=30.0, factor=2.0, clock=clock, sleep=clock.sleep, **kwargs)
+
+class ExportPollerTest(unittest.TestCase):
+    def test_backoff_while_stalled(self):
+        clock = Clock()
+        p = poller(clock)
+        for i in range(7):
+            p.wait(0)
+        self.assertEqual(clock.sleeps, [1.0, 2.0, 4.0, 8.0, 16.0, 30.0, 30.0])
+
+    def test_jitter(self):
+        clock = Clock()
+        self.assertAlmostEqual(poller(clock, jitter=0.1, rand=lambda: 0.0).next_interval(0), 0.9)
+        self.assertAlmostEqual(poller(clock, jitter=0.1, rand=lambda: 1.0).next_interval(0), 1.1)
+
+    def test_eta_from_progress(self):
+        clock = Clock()
+        p = poller(clock)
+        p.wait(0) # 1s
+        p.wait(0) # stalled: 2s
+        p.wait(10) # 10% in 2s: 90% left at 5%/s, half of the 18s ETA
+        self.assertEqual(clock.sleeps[-1], 9.0)
+        p.wait(90) # 80% in 9s: 10% left takes 1.125s, below the initial interval
+        self.assertEqual(clock.sleeps[-1], 1.0)
+        p.wait(90) # stalled again: back to backoff from there
+        self.assertEqual(clock.sleeps[-1], 2.0)
+
+    def test_timeout(self):
+        clock = Clock()
+        p = poller(clock, timeout=10.0)
+        for i in range(3):
+            p.wait(0) # 1 + 2 + 4s
+        self.assertEqual(p.next_interval(0), 3.0) # never sleeps past the timeout
+        clock.now = 10.0
+        with self.assertRaises(QualtricsException):
+            p.next_interval(0)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    def log_message(self, *args):
+        pass
+    def record(self, body=None):
+        # the client sends absolute URLs
+        self.server.requests.append((self.command, "/" + urlparse(self.path).path.lstrip("/"), body))
+    def send(self, body, status=200):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def do_POST(self):
+        post = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.record(post)
+        self.send(json.dumps({"result": {"id": "ES_1"}, "meta": {}}).encode())
+    def do_GET(self):
+        self.record()
+        if self.path.endswith("/file"):
+            buf = io.BytesIO()
+            with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+                z.writestr("Test survey.json", json.dumps({"responses": [{"ResponseID": "R_1"}]}))
+            self.send(buf.getvalue())
+            return
+        progress = self.server.progress.pop(0) if len(self.server.progress) > 1 else self.server.progress[0]
+        url = "http://{0}/API/v3/responseexports/ES_1/file".format(self.headers["Host"])
+        self.send(json.dumps({"result": {"percentComplete": progress, "file": url}, "meta": {}}).encode())
+
+class ResponseExportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.q = Qualtrics_v3("127.0.0.1:{0}".format(self.server.server_address[1]), "token", scheme="http")
+    def tearDown(self):
+        self.q.response_clean()
+        self.q.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_round_trip(self):
+        self.server.progress = [0, 0, 10, 50, 100]
+        clock = Clock()
+        events = []
+        path = self.q.response_export("SV_1", "json", poller=poller(clock), callback=lambda *a: events.append(a))
+        with open(path) as f:
+            self.assertEqual(json.load(f), {"responses": [{"ResponseID": "R_1"}]})
+        self.assertEqual(self.server.requests[0], ("POST", "/API/v3/responseexports", {"surveyId": "SV_1", "format": "json"}))
+        self.assertEqual([r[1] for r in self.server.requests[1:]], ["/API/v3/responseexports/ES_1"] * 5 +
+            ["/API/v3/responseexports/ES_1/file"])
+        self.assertEqual(clock.sleeps, [1.0, 2.0, 9.0, 5.625])
+        self.assertEqual([e for e in events if e[0] == "export"], [("export", p, 100) for p in (0, 0, 10, 50, 100)])
+        self.assertEqual(events[-1][0], "downloaded")
+
+    def test_timeout(self):
+        self.server.progress = [0, 5]
+        clock = Clock()
+        with self.assertRaises(QualtricsException):
+            self.q.response_export("SV_1", "json", poller=poller(clock, timeout=60.0), callback=lambda *a: None)
+        self.assertAlmostEqual(sum(clock.sleeps), 60.0)
+        self.assertFalse(any(r[1].endswith("/file") for r in self.server.requests))
+
+if __name__ == "__main__":
+    unittest.main()
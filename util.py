@@ -1,11 +1,10 @@
-import os
 import numpy as np
 import pandas as pd
+import shutil
 
 def reload_window():
-    rows, cols = os.popen('stty size', 'r').read().split()
-    rows = int(rows)
-    cols = int(cols)
+    # Falls back to $COLUMNS (or 80 columns) when there is no terminal, e.g. under cron
+    cols, rows = shutil.get_terminal_size()
     pd.set_option('display.width',cols)
 
 def likert_mean(indata, lsize=5):                         